@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import sys
+import base64
+import binascii
+import timeit
+import argparse
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxwindownotify.maxwindownotify import MaxConnection
+from fake_cube import build_m_line, build_l_line
+
+
+def legacy_decode_m_line(m_line):
+    """
+    The previous BytesIO based M: line decoder
+    """
+    encoded = m_line.strip().split(b',', 2)[2]
+    decoded = BytesIO(base64.decodestring(encoded))
+
+    data = {}
+    decoded.read(2)
+    data['room_count'] = ord(decoded.read(1))
+
+    data['rooms'] = {}
+    for i in range(data['room_count']):
+        room = {'id': ord(decoded.read(1)), 'name_len': ord(decoded.read(1))}
+        room['name'] = decoded.read(room['name_len'])
+        room['rf_address'] = binascii.b2a_hex(decoded.read(3))
+        data['rooms'][room['id']] = room
+
+    data['devices_count'] = ord(decoded.read(1))
+    data['devices'] = []
+    for i in range(data['devices_count']):
+        device = {'type': ord(decoded.read(1)), 'rf_address': binascii.b2a_hex(decoded.read(3)),
+                  'serial': decoded.read(10), 'name_len': ord(decoded.read(1))}
+        device['name'] = decoded.read(device['name_len'])
+        device['room_id'] = ord(decoded.read(1))
+        data['devices'].append(device)
+
+    decoded.read(1)
+
+    return data
+
+
+def legacy_decode_l_line(l_line):
+    """
+    The previous BytesIO based L: line decoder
+    """
+    encoded = l_line.strip()[2:]
+    decoded = BytesIO(base64.decodestring(encoded))
+    data = {}
+    while True:
+        device = {}
+        try:
+            device['len'] = ord(decoded.read(1))
+        except TypeError:
+            break
+        device['rf_address'] = binascii.b2a_hex(decoded.read(3))
+        decoded.read(1)
+        device['flags_1'] = ord(decoded.read(1))
+        device['flags_2'] = ord(decoded.read(1))
+        if device['len'] > 6:
+            decoded.read(device['len'] - 6)
+        data[device['rf_address']] = device
+    return data
+
+
+def report(name, decoder, line, runs):
+    duration = min(timeit.repeat(lambda: decoder(line), number=runs, repeat=3)) / runs
+    print '{:<16} {:>10.1f}us per line'.format(name, duration * 1000000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark of the M: and L: line decoders over synthetic "
+                                                 "payloads")
+    parser.add_argument("-d", "--devices", help="number of devices in the L: line (default 5000)",
+                        type=int, default=5000)
+    parser.add_argument("-r", "--runs", help="decodes per measurement (default 100)", type=int, default=100)
+    args = parser.parse_args()
+
+    # the M: line stores the device count in a single byte
+    m_line = build_m_line(255).strip()
+    l_line = build_l_line(args.devices).strip()
+
+    print 'M: line with 255 devices'
+    report('legacy', legacy_decode_m_line, m_line, args.runs)
+    report('struct', MaxConnection._decode_m_line, m_line, args.runs)
+    print 'L: line with {} devices'.format(args.devices)
+    report('legacy', legacy_decode_l_line, l_line, args.runs)
+    report('struct', MaxConnection._decode_l_line, l_line, args.runs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import sys
+import socket
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxwindownotify.maxwindownotify import scan_for_cube
+
+
+def blackhole_listener(ip, port):
+    """
+    Creates a listener on ip:port whose accept queue is full, so further connection attempts
+    are silently dropped and run into the connect timeout just like a host without a MAX Cube
+    :return: list of sockets to keep open for the duration of the benchmark
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((ip, port))
+    listener.listen(0)
+    sockets = [listener]
+    for i in range(2):
+        filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        filler.setblocking(0)
+        filler.connect_ex((ip, port))
+        sockets.append(filler)
+    time.sleep(0.05)
+    return sockets
+
+
+def sequential_scan(hosts, port, timeout=0.5):
+    for ip in hosts:
+        tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_socket.settimeout(timeout)
+        try:
+            tcp_socket.connect((ip, port))
+            return ip
+        except (socket.timeout, socket.error):
+            pass
+        finally:
+            tcp_socket.close()
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tcp scan fallback of the MAX Cube discovery "
+                                                 "against a local stub listener")
+    parser.add_argument("-d", "--decoys", help="number of non responding hosts before the cube (default 32)",
+                        type=int, default=32)
+    parser.add_argument("-p", "--port", help="tcp port to scan (default 62910)", type=int, default=62910)
+    parser.add_argument("-j", "--parallelism", help="concurrent connection attempts (default 64)",
+                        type=int, default=64)
+    args = parser.parse_args()
+
+    hosts = ['127.0.1.{}'.format(i + 1) for i in range(args.decoys + 1)]
+    keep_open = []
+    for ip in hosts[:-1]:
+        keep_open.extend(blackhole_listener(ip, args.port))
+
+    cube = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    cube.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    cube.bind((hosts[-1], args.port))
+    cube.listen(128)
+
+    start = time.time()
+    found = sequential_scan(hosts, args.port)
+    sequential_duration = time.time() - start
+    print 'sequential scan: found {} in {:.3f}s'.format(found, sequential_duration)
+
+    start = time.time()
+    found = scan_for_cube(hosts, args.port, parallelism=args.parallelism)
+    concurrent_duration = time.time() - start
+    print 'concurrent scan: found {} in {:.3f}s'.format(found, concurrent_duration)
+
+    for tcp_socket in keep_open + [cube]:
+        tcp_socket.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import sys
+import socket
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxwindownotify.maxwindownotify import MaxConnection
+from fake_cube import FakeCube
+
+
+def timeout_based_fetch(ip, port):
+    """
+    The previous way of reading the cube data: recv until the 3s socket timeout fires
+    """
+    tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp_socket.settimeout(3)
+    tcp_socket.connect((ip, port))
+    received_data = b''
+    while True:
+        try:
+            received_data += tcp_socket.recv(100000)
+        except (socket.timeout, socket.error):
+            break
+    tcp_socket.close()
+    return received_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MAX Cube data fetch latency against a local fake cube")
+    parser.add_argument("-d", "--devices", help="number of devices served by the fake cube (default 50)",
+                        type=int, default=50)
+    parser.add_argument("-r", "--runs", help="number of framed fetches to average (default 100)",
+                        type=int, default=100)
+    args = parser.parse_args()
+
+    fake_cube = FakeCube(device_count=args.devices)
+    fake_cube.start()
+    max_cube = MaxConnection(cube_ip=fake_cube.host, cube_port=fake_cube.port)
+
+    start = time.time()
+    legacy_data = timeout_based_fetch(fake_cube.host, fake_cube.port)
+    print 'timeout based fetch: {} bytes in {:.3f}s'.format(len(legacy_data), time.time() - start)
+
+    start = time.time()
+    for i in range(args.runs):
+        framed_data = max_cube._get_cube_data()
+    duration = (time.time() - start) / args.runs
+    print 'framed fetch: {} bytes in {:.3f}ms (average of {} runs)'.format(len(framed_data), duration * 1000,
+                                                                          args.runs)
+
+    persistent_cube = MaxConnection(cube_ip=fake_cube.host, cube_port=fake_cube.port, persistent=True)
+    persistent_cube._get_cube_data()
+    start = time.time()
+    for i in range(args.runs):
+        persistent_cube._get_cube_data()
+    duration = (time.time() - start) / args.runs
+    print 'persistent status refresh: {} bytes in {:.3f}ms (average of {} runs)'.format(
+        len(fake_cube.l_line), duration * 1000, args.runs)
+    persistent_cube.close()
+    fake_cube.stop()
+
+
+if __name__ == '__main__':
+    main()
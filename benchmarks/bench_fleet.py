@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxwindownotify.maxwindownotify import MaxConnection, NotificationState, PollScheduler, FleetSite, \
+    FleetSupervisor
+from fake_cube import FakeCube
+
+
+def serve_fake_cubes(cube_count, device_count, ports):
+    """
+    Runs the emulated MAX Cubes in a child process, so their CPU time is not counted for the supervisor
+    """
+    fake_cubes = [FakeCube(device_count=device_count) for i in range(cube_count)]
+    for fake_cube in fake_cubes:
+        fake_cube.start()
+    ports.send([fake_cube.port for fake_cube in fake_cubes])
+    while True:
+        time.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark how many MAX Cubes one core can supervise in fleet mode "
+                                                 "against local emulated cubes")
+    parser.add_argument("-n", "--cubes", help="number of emulated MAX Cubes (default 200)", type=int, default=200)
+    parser.add_argument("-d", "--devices", help="number of devices per cube (default 20)", type=int, default=20)
+    parser.add_argument("-i", "--interval", help="poll interval of each cube in seconds (default 1)",
+                        type=float, default=1)
+    parser.add_argument("-j", "--concurrency", help="maximum number of concurrent polls (default 16)",
+                        type=int, default=16)
+    parser.add_argument("-t", "--duration", help="seconds to run the fleet for (default 10)", type=float, default=10)
+    parser.add_argument("--persistent", help="keep the connections to the cubes open", action="store_true")
+    args = parser.parse_args()
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    cubes_process = multiprocessing.Process(target=serve_fake_cubes, args=(args.cubes, args.devices, sender))
+    cubes_process.daemon = True
+    cubes_process.start()
+    ports = receiver.recv()
+
+    # all windows stay closed, so neither the weather nor the notifiers are involved
+    sites = [FleetSite('cube-{}'.format(i), MaxConnection(cube_ip='127.0.0.1', cube_port=port,
+                                                          persistent=args.persistent, rediscover_after=0),
+                       [], None, 'munich,DE', 12, NotificationState(notify_after=60),
+                       PollScheduler(args.interval, args.interval, args.interval, jitter=0))
+             for i, port in enumerate(ports)]
+    supervisor = FleetSupervisor(sites, args.concurrency)
+
+    cpu_start = sum(os.times()[:2])
+    start = time.time()
+    supervisor.start()
+    time.sleep(args.duration)
+    supervisor.stop()
+    duration = time.time() - start
+    cpu_time = sum(os.times()[:2]) - cpu_start
+    cubes_process.terminate()
+
+    cpu_per_poll = cpu_time / max(supervisor.polls, 1)
+    print '{} cubes, {} polls ({} failed) in {:.1f}s, {:.0f} polls/s'.format(
+        args.cubes, supervisor.polls, supervisor.failures, duration, supervisor.polls / duration)
+    print 'CPU time per poll: {:.3f}ms, {:.0f}% of one core'.format(cpu_per_poll * 1000, cpu_time / duration * 100)
+    for interval in (60, 300, 1800):
+        print 'cubes per core at a {} minute poll interval: {:.0f}'.format(interval // 60, interval / cpu_per_poll)
+
+
+if __name__ == '__main__':
+    main()
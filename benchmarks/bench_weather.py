@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxwindownotify.maxwindownotify import OpenWeatherMap
+
+
+class StubWeatherHandler(BaseHTTPRequestHandler):
+    """
+    Answers the weather and group endpoints of Open Weather Map with a temperature derived from the location
+    """
+    latency = 0.05
+    requests = 0
+
+    def do_GET(self):
+        StubWeatherHandler.requests += 1
+        time.sleep(self.latency)
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path.endswith('/group'):
+            body = {'cnt': 0, 'list': []}
+            for city_id in query['id'][0].split(','):
+                body['list'].append({'id': int(city_id), 'main': {'temp': int(city_id) % 30}})
+            body['cnt'] = len(body['list'])
+        elif query['q'][0].isdigit():
+            body = {'id': int(query['q'][0]), 'main': {'temp': int(query['q'][0]) % 30}}
+        else:
+            body = {'name': query['q'][0], 'main': {'temp': len(query['q'][0])}}
+
+        data = json.dumps(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubWeatherServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare single and batched Open Weather Map lookups against a local "
+                                                 "stub HTTP server")
+    parser.add_argument("-l", "--locations", help="number of distinct locations (default 40)", type=int, default=40)
+    parser.add_argument("--latency", help="stub server latency in seconds (default 0.05)", type=float, default=0.05)
+    args = parser.parse_args()
+
+    StubWeatherHandler.latency = args.latency
+    server = StubWeatherServer(('127.0.0.1', 0), StubWeatherHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    base_url = 'http://127.0.0.1:{}/data/2.5/'.format(server.server_address[1])
+
+    # half of the locations are city names, half numeric city IDs, every location is requested twice
+    locations = ['city{}'.format(i) for i in range(args.locations // 2)]
+    locations += [str(2950000 + i) for i in range(args.locations - len(locations))]
+    locations = locations * 2
+
+    weather = OpenWeatherMap('stub', apiurl=base_url + 'weather', groupurl=base_url + 'group')
+    StubWeatherHandler.requests = 0
+    start = time.time()
+    single = dict((city, weather._retrieve_temperature(city, 'metric')) for city in locations)
+    print 'single lookups:  {} requests in {:.3f}s'.format(StubWeatherHandler.requests, time.time() - start)
+
+    weather = OpenWeatherMap('stub', apiurl=base_url + 'weather', groupurl=base_url + 'group')
+    StubWeatherHandler.requests = 0
+    start = time.time()
+    batched = weather.get_current_temperatures(locations)
+    print 'batched lookups: {} requests in {:.3f}s'.format(StubWeatherHandler.requests, time.time() - start)
+
+    if dict(batched) != single:
+        sys.exit('batched temperatures differ from the single lookups')
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxwindownotify.maxwindownotify import MaxConnection, read_capture
+
+# ranges a MAX device can report, anything outside points to a decoding error
+SETPOINT_RANGE = (4.5, 30.5)
+TEMPERATURE_RANGE = (0.0, 51.1)
+
+
+def check_device(device):
+    """
+    :param device: a device as returned by DeviceStateTable.get
+    :return: list of the implausible values of the device
+    """
+    problems = []
+    if device['valve_position'] is not None and not 0 <= device['valve_position'] <= 100:
+        problems.append('valve position {}'.format(device['valve_position']))
+    if device['setpoint'] is not None and not SETPOINT_RANGE[0] <= device['setpoint'] <= SETPOINT_RANGE[1]:
+        problems.append('setpoint {}'.format(device['setpoint']))
+    if device['actual_temperature'] is not None and \
+            not TEMPERATURE_RANGE[0] < device['actual_temperature'] <= TEMPERATURE_RANGE[1]:
+        problems.append('actual temperature {}'.format(device['actual_temperature']))
+    if device['mode'] == 'vacation' and device['actual_temperature'] is not None:
+        problems.append('actual temperature {} in vacation mode'.format(device['actual_temperature']))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode the L: lines of a real MAX Cube, from a capture written by "
+                                                 "--record or polled once, and check that the thermostat values "
+                                                 "are plausible")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--capture", help="capture file written by maxwindownotify --record", metavar="FILE")
+    source.add_argument("--cube", help="IP of a MAX Cube to poll once", metavar="IP")
+    parser.add_argument("-v", "--verbose", help="print every decoded device", action="store_true")
+    args = parser.parse_args()
+
+    if args.capture:
+        records = [cube_data for timestamp, cube_data in read_capture(args.capture)]
+    else:
+        records = [MaxConnection(cube_ip=args.cube, rediscover_after=0)._get_cube_data()]
+
+    max_cube = MaxConnection(cube_ip='0.0.0.0', rediscover_after=0)
+    devices = 0
+    problems = 0
+    for cube_data in records:
+        if not cube_data:
+            continue
+        device_states = max_cube._read_cube_data_lines(cube_data)[1]
+        for rf_address in device_states.rf_address:
+            device = device_states.get(rf_address)
+            devices += 1
+            if args.verbose:
+                print '{:06x}: {}'.format(rf_address, device)
+            for problem in check_device(device):
+                problems += 1
+                print '{:06x}: implausible {}, decoded as {}'.format(rf_address, problem, device)
+
+    print 'checked {} device states of {} records, {} implausible values'.format(devices, len(records), problems)
+    sys.exit(1 if problems or not devices else 0)
+
+
+if __name__ == '__main__':
+    main()
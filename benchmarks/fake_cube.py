@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import time
+import socket
+import struct
+import base64
+import argparse
+import threading
+
+DEVICE_TYPE_HEATING_THERMOSTAT = 1
+DEVICE_TYPE_WINDOW_SWITCH = 4
+
+HELLO_DATA = '6551334d61782a002a2a2a2a2a2a2a2a2a2a49'.decode('hex')
+
+
+def build_m_line(device_count, window_every=2, room_count=None):
+    """
+    Builds a synthetic M: line
+    :param device_count: number of devices (at most 255, the M: line stores the count in one byte)
+    :param window_every: every n-th device is a window switch, all others are heating thermostats
+    :param room_count: number of rooms the devices are spread over, defaults to one room per device pair
+    :return: the M: line including the trailing CRLF
+    """
+    room_count = room_count or (device_count + 1) // 2
+    payload = [struct.pack('>BBB', 0x56, 0x02, room_count)]
+    for room_id in range(1, room_count + 1):
+        name = 'Room {}'.format(room_id)
+        payload.append(struct.pack('>BB', room_id, len(name)) + name + struct.pack('>I', room_id)[1:])
+
+    payload.append(struct.pack('>B', device_count))
+    for i in range(device_count):
+        device_type = DEVICE_TYPE_WINDOW_SWITCH if i % window_every == 0 else DEVICE_TYPE_HEATING_THERMOSTAT
+        name = 'Device {}'.format(i)
+        payload.append(struct.pack('>I', device_type << 24 | 0x100000 + i) + 'KEQ{:07d}'.format(i) +
+                       struct.pack('>B', len(name)) + name + struct.pack('>B', i * room_count // device_count + 1))
+    payload.append(b'\x01')
+
+    return b'M:00,01,' + base64.b64encode(b''.join(payload)) + b'\r\n'
+
+
+def build_l_line(device_count, window_every=2, open_windows=()):
+    """
+    Builds a synthetic L: line matching the devices of build_m_line
+    :param device_count: number of devices
+    :param window_every: every n-th device is a window switch, all others are heating thermostats
+    :param open_windows: indexes of the window switches reported as open
+    :return: the L: line including the trailing CRLF
+    """
+    payload = []
+    for i in range(device_count):
+        rf_address = struct.pack('>I', 0x100000 + i)[1:]
+        if i % window_every == 0:
+            flags_2 = 0x12 if i in open_windows else 0x10
+            payload.append(struct.pack('>B', 6) + rf_address + struct.pack('>BBB', 0x12, 0x18, flags_2))
+        else:
+            payload.append(struct.pack('>B', 11) + rf_address +
+                           struct.pack('>BBBBBHB', 0x09, 0x12, 0x18, 0x20, 0x2c, 0x00ee, 0x00))
+
+    return b'L:' + base64.b64encode(b''.join(payload)) + b'\r\n'
+
+
+def build_cube_dump(device_count, window_every=2, open_windows=(), room_count=None):
+    """
+    Builds the data a MAX Cube sends right after a client connected
+    :return: the H:, M:, C: and L: lines as one string
+    """
+    lines = [b'H:KEQ0523864,097f2c,0113,00000000,74b7b6f7,00,32,0f0c19,1527,03,0000\r\n',
+             build_m_line(device_count, window_every, room_count)]
+    for i in range(device_count):
+        lines.append(b'C:{:06x},{}\r\n'.format(0x100000 + i, base64.b64encode(struct.pack('>I', i) * 4)))
+    lines.append(build_l_line(device_count, window_every, open_windows))
+    return b''.join(lines)
+
+
+class FakeCube:
+    def __init__(self, device_count=20, host='127.0.0.1', port=0, echo_port=None, serial='KEQ0523864',
+                 room_count=None, window_every=2, latency=0, chunk_size=None, chunk_delay=0):
+        """
+        MAX Cube emulator. Each TCP client gets the H:, M:, C: and L: dump, and like a real cube the connection is
+        kept open afterwards with each 'l:' request answered by a fresh L: line. If echo_port is set the
+        discover hello is answered on UDP as well
+        :param device_count: number of devices in the synthetic dump
+        :param host: address to listen on
+        :param port: TCP port to listen on, 0 picks a free port
+        :param echo_port: UDP port to answer the discover hello on, None disables the discovery
+        :param serial: serial number sent in the discover reply
+        :param room_count: number of rooms, defaults to one room per device pair
+        :param window_every: every n-th device is a window switch, all others are heating thermostats
+        :param latency: seconds to wait before answering a connection, 'l:' request or discover hello
+        :param chunk_size: send the data in chunks of this many bytes, None sends it at once
+        :param chunk_delay: seconds to wait between two chunks
+        """
+        self.device_count = device_count
+        self.window_every = window_every
+        self.room_count = room_count
+        self.serial = serial
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.set_open_windows(())
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(128)
+        self.host, self.port = self._listener.getsockname()
+
+        self._udp_socket = None
+        if echo_port:
+            self.echo_port = echo_port
+            self._udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._udp_socket.bind((host, echo_port))
+
+    def set_open_windows(self, open_windows):
+        """
+        Changes the window switches reported as open
+        :param open_windows: indexes of the open window switch devices
+        """
+        self.dump = build_cube_dump(self.device_count, self.window_every, open_windows, self.room_count)
+        self.l_line = build_l_line(self.device_count, self.window_every, open_windows)
+
+    def start(self):
+        self._start_thread(self._accept_clients)
+        if self._udp_socket:
+            self._start_thread(self._answer_discovery)
+
+    def stop(self):
+        self._listener.close()
+        if self._udp_socket:
+            self._udp_socket.close()
+
+    @staticmethod
+    def _start_thread(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _send(self, client, data):
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.chunk_size:
+            client.sendall(data)
+            return
+        for offset in range(0, len(data), self.chunk_size):
+            if offset and self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            client.sendall(data[offset:offset + self.chunk_size])
+
+    def _accept_clients(self):
+        while True:
+            try:
+                client, addr = self._listener.accept()
+            except socket.error:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._start_thread(self._serve_client, client)
+
+    def _serve_client(self, client):
+        try:
+            self._send(client, self.dump)
+            # keep the connection open until the client hangs up
+            request = client.recv(4096)
+            while request:
+                if request.startswith(b'l:'):
+                    self._send(client, self.l_line)
+                request = client.recv(4096)
+        except socket.error:
+            pass
+        client.close()
+
+    def _answer_discovery(self):
+        while True:
+            try:
+                data, addr = self._udp_socket.recvfrom(4096)
+            except socket.error:
+                return
+            if data == HELLO_DATA:
+                if self.latency:
+                    time.sleep(self.latency)
+                self._udp_socket.sendto(b'eQ3MaxAp' + self.serial + b'>I\x00\x01\x13', (addr[0], self.echo_port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MAX Cube emulator serving synthetic rooms and devices")
+    parser.add_argument("--host", help="address to listen on (default 127.0.0.3, the broadcast address of "
+                                       "127.0.0.0/30)", default='127.0.0.3')
+    parser.add_argument("--port", help="TCP port (default 62910)", type=int, default=62910)
+    parser.add_argument("--echo-port", help="UDP discovery port (default 23272)", type=int, default=23272)
+    parser.add_argument("-d", "--devices", help="number of devices (default 20)", type=int, default=20)
+    parser.add_argument("-r", "--rooms", help="number of rooms (default one per device pair)", type=int)
+    parser.add_argument("-o", "--open", help="index of an open window switch, can be given several times",
+                        type=int, action="append", default=[])
+    parser.add_argument("--latency", help="seconds to wait before answering (default 0)", type=float, default=0)
+    parser.add_argument("--chunk-size", help="send the data in chunks of this many bytes", type=int)
+    args = parser.parse_args()
+
+    fake_cube = FakeCube(args.devices, host=args.host, port=args.port, echo_port=args.echo_port,
+                         room_count=args.rooms, latency=args.latency, chunk_size=args.chunk_size)
+    fake_cube.set_open_windows(args.open)
+    fake_cube.start()
+    print 'MAX Cube emulator listening on {}:{}'.format(fake_cube.host, fake_cube.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake_cube.stop()
+
+
+if __name__ == '__main__':
+    main()
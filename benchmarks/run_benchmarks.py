@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from maxwindownotify.maxwindownotify import MaxConnection
+from fake_cube import FakeCube
+
+
+def measure(name, func, runs):
+    """
+    Calls func runs times and collects the latency statistics
+    :param name: name of the benchmark in the results file
+    :param func: callable to benchmark
+    :param runs: number of calls
+    :return: a dict with the min, median, mean and max latency in milliseconds
+    """
+    durations = []
+    for i in range(runs):
+        start = time.time()
+        func()
+        durations.append((time.time() - start) * 1000)
+    durations.sort()
+
+    result = {'name': name,
+              'runs': runs,
+              'min_ms': round(durations[0], 4),
+              'median_ms': round(durations[runs // 2], 4),
+              'mean_ms': round(sum(durations) / runs, 4),
+              'max_ms': round(durations[-1], 4)}
+    print '{:<36} median {:>9.3f}ms  mean {:>9.3f}ms  max {:>9.3f}ms'.format(
+        name, result['median_ms'], result['mean_ms'], result['max_ms'])
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the MAX Cube benchmark suite against the local emulator and "
+                                                 "write the results as JSON")
+    parser.add_argument("-d", "--devices", help="number of devices served by the emulator (default 100)",
+                        type=int, default=100)
+    parser.add_argument("--rooms", help="number of rooms (default one per device pair)", type=int)
+    parser.add_argument("-r", "--runs", help="number of runs per benchmark (default 200)", type=int, default=200)
+    parser.add_argument("--latency", help="seconds the emulator waits before answering (default 0)",
+                        type=float, default=0)
+    parser.add_argument("--chunk-size", help="emulator sends the data in chunks of this many bytes", type=int)
+    parser.add_argument("--host", help="emulator address, must be the broadcast address of --network "
+                                       "(default 127.0.0.3)", default='127.0.0.3')
+    parser.add_argument("--network", help="subnet the discovery broadcast is sent to (default 127.0.0.0/30)",
+                        default='127.0.0.0/30')
+    parser.add_argument("--echo-port", help="UDP port of the discovery (default 23272)", type=int, default=23272)
+    parser.add_argument("-o", "--output", help="results file (default benchmark_results.json)",
+                        default='benchmark_results.json')
+    args = parser.parse_args()
+
+    fake_cube = FakeCube(device_count=args.devices, host=args.host, echo_port=args.echo_port,
+                         room_count=args.rooms, latency=args.latency, chunk_size=args.chunk_size)
+    fake_cube.set_open_windows(range(0, args.devices, 4))
+    fake_cube.start()
+
+    max_cube = MaxConnection(discover_ip_subnet=args.network, echo_port=args.echo_port, cube_port=fake_cube.port,
+                             cube_ip=fake_cube.host)
+    persistent_cube = MaxConnection(cube_ip=fake_cube.host, cube_port=fake_cube.port, persistent=True)
+
+    cube_data = max_cube._get_cube_data()
+    lines = dict((line[:2], line) for line in cube_data.split(b'\r\n') if line)
+    m_line, l_line = lines[b'M:'], lines[b'L:']
+
+    results = [
+        measure('discover_cube', max_cube.discover_cube, min(args.runs, 20)),
+        measure('get_cube_data', max_cube._get_cube_data, args.runs),
+        measure('get_cube_data_persistent', persistent_cube._get_cube_data, args.runs),
+        measure('decode_m_line', lambda: MaxConnection._decode_m_line(m_line), args.runs),
+        measure('decode_l_line', lambda: MaxConnection._decode_l_line(l_line), args.runs),
+        measure('read_cube_data_lines', lambda: max_cube._read_cube_data_lines(cube_data), args.runs),
+        measure('window_switch_status', max_cube.window_switch_status, args.runs),
+        measure('window_switch_status_persistent', persistent_cube.window_switch_status, args.runs),
+    ]
+    persistent_cube.close()
+    fake_cube.stop()
+
+    report = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'config': {'devices': args.devices,
+                         'rooms': args.rooms,
+                         'latency': args.latency,
+                         'chunk_size': args.chunk_size,
+                         'bytes': len(cube_data)},
+              'results': results}
+    with open(args.output, 'w') as results_file:
+        json.dump(report, results_file, indent=2, sort_keys=True)
+    print 'results written to {}'.format(args.output)
+
+
+if __name__ == '__main__':
+    main()
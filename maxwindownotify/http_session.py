@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from collections import OrderedDict
+
+
+class Session:
+    def __init__(self, debug=False, verify=False, suppress_warnings=False, timeout=(3.05, 10), retries=0,
+                 backoff_factor=0.5, pool_maxsize=10):
+        """
+        HTTP transport shared by all outbound requests, connections are kept alive in a pool per host
+        :param debug: sends HTTPLIB debug output to stdout if set to 'True'
+        :param verify: verify the TLS certificates of the servers
+        :param suppress_warnings: disable the InsecureRequestWarnings caused by self signed certs
+        :param timeout: default (connect, read) timeout in seconds for each request
+        :param retries: number of retries of failed idempotent requests, 0 disables retries
+        :param backoff_factor: the retries back off for backoff_factor * (2 ^ (retry number - 1)) seconds
+        :param pool_maxsize: maximum number of connections kept alive per host
+        """
+        self._debug = debug
+        self._verify = verify
+        self._suppress_warnings = suppress_warnings
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._session.verify = self._verify
+
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize,
+                              max_retries=Retry(total=retries, backoff_factor=backoff_factor,
+                                                status_forcelist=(500, 502, 503, 504)))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        # if debug then enable underlying httplib debugging
+        if self._debug:
+            import httplib
+            httplib.HTTPConnection.debuglevel = 1
+
+        # if suppress_warnings then disable any InsecureRequestWarnings caused by self signed certs
+        if self._suppress_warnings:
+            requests.packages.urllib3.disable_warnings()
+
+    def do_request(self, method, url, data=None, headers=None, params=None, timeout=None):
+            """
+            Handle API requests / responses transport
+            :param method: HTTP method to use as string
+            :param data: Any data to be send in the request, a string is sent as JSON body and a dict is sent
+            form encoded
+            :param headers: Any headers as PyDict
+            :param params: Any query parameters as PyDict
+            :param timeout: (connect, read) timeout in seconds overriding the default of the session
+            :return: response as Ordered Dict with Status Code, Reason and Body
+            """
+
+            if data and not isinstance(data, dict):
+                if headers:
+                    headers.update({'Content-Type': 'application/json'})
+                else:
+                    headers = {'Content-Type': 'application/json'}
+
+            try:
+                response = self._session.request(method, url, headers=headers, params=params, data=data,
+                                                 timeout=timeout or self._timeout)
+            except requests.exceptions.RequestException as e:
+                return OrderedDict([('status', 'connection exception'), ('reason', None), ('body', e)])
+
+            response_content = response.content
+
+            if response.status_code in [200]:
+                if response.headers.get('Content-Type', '').find('application/json') != -1:
+                    try:
+                        response_content = response.json()
+                    except ValueError:
+                        pass
+
+            return OrderedDict([('status', response.status_code), ('reason', response.reason),
+                                ('body', response_content)])
@@ -21,81 +21,544 @@ __author__ = 'yfauser'
 
 from netaddr import IPNetwork
 import socket
+import select
+import errno
 import sys
 import base64
-from io import BytesIO
 import binascii
+import struct
+import threading
+import hashlib
 import random
+import os
+import signal
+import array
+import bisect
+import heapq
+import mmap
+import itertools
+import ctypes
+import ctypes.util
 import time
 import argparse
 import logging
-from notifier_modules.pushover_notifier import Notifier
-import requests
+from notifier_modules import available_notifiers, get_notifier, NotifierGroup
+from http_session import Session
+from rules import RuleSet
+from snapshot import SnapshotStore
+import snapshot
+import metrics
 import json
 from collections import OrderedDict
 
+# single byte, M: line room header (id, name length), device header (type, rf address, serial, name length)
+# and L: line record header (length, rf address, unknown byte, flags 1, flags 2)
+_BYTE = struct.Struct('>B')
+_M_ROOM = struct.Struct('>BB')
+_M_DEVICE = struct.Struct('>BBH10sB')
+_L_RECORD = struct.Struct('>BBHxBB')
+# L: line thermostat record: the record header followed by valve position, setpoint and the two bytes holding the
+# date until (vacation mode) or the actual temperature
+_L_THERMOSTAT_RECORD = struct.Struct('>BBHxBBBBBB')
 
-class Session:
-    def __init__(self, debug=False, verify=False, suppress_warnings=False):
-        self._debug = debug
-        self._verify = verify
-        self._suppress_warnings = suppress_warnings
-        self._session = requests.Session()
-        self._session.verify = self._verify
-
-        # if debug then enable underlying httplib debugging
-        if self._debug:
-            import httplib
-            httplib.HTTPConnection.debuglevel = 1
-
-        # if suppress_warnings then disable any InsecureRequestWarnings caused by self signed certs
-        if self._suppress_warnings:
-            requests.packages.urllib3.disable_warnings()
-
-    def do_request(self, method, url, data=None, headers=None, params=None):
-            """
-            Handle API requests / responses transport
-            :param method: HTTP method to use as string
-            :param data: Any data to be send in the request
-            :param headers: Any headers as PyDict
-            :param params: Any query parameters as PyDict
-            :return: response as Ordered Dict with Status Code and Body
-            """
-
-            if data:
-                if headers:
-                    headers.update({'Content-Type': 'application/json'})
+# default deadlines in seconds of the stages of a poll cycle, see CycleBudget
+STAGE_DEADLINES = OrderedDict([('discover', 60), ('fetch', 20), ('decode', 5), ('weather', 15), ('notify', 60)])
+
+# clock id of CLOCK_MONOTONIC on Linux
+_CLOCK_MONOTONIC = 1
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _linux_monotonic():
+    """
+    Python 2.7 has no monotonic clock in the standard library, on Linux CLOCK_MONOTONIC is read through ctypes, so
+    the poll deadlines and stage timings don't jump when the wall clock is stepped, e.g. by NTP
+    :return: function returning the monotonic time in seconds, or None if CLOCK_MONOTONIC is not available
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    # glibc before 2.17 has clock_gettime in librt
+    for library in ('c', 'rt'):
+        try:
+            clock_gettime = ctypes.CDLL(ctypes.util.find_library(library), use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+        def monotonic():
+            timespec = _Timespec()
+            if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(timespec)):
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error))
+            return timespec.tv_sec + timespec.tv_nsec * 1e-9
+
+        try:
+            monotonic()
+        except OSError:
+            continue
+        return monotonic
+    return None
+
+# other platforms fall back to the wall clock, PollScheduler bounds its delays for clock steps there
+_monotonic = getattr(time, 'monotonic', None) or _linux_monotonic() or time.time
+
+# connect_ex() return codes meaning a non-blocking connect is still in flight
+_CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, getattr(errno, 'WSAEWOULDBLOCK', 10035))
+
+# capture files written by --record start with a magic string followed by the raw MAX Cube data of each poll,
+# every payload prefixed by the time it was received and its length
+_CAPTURE_MAGIC = b'MAXCAP01'
+_CAPTURE_RECORD = struct.Struct('>dI')
+
+# metrics exposed through --metrics-port, updating them is a no-op while the endpoint is disabled
+_CUBE_CONNECT_SECONDS = metrics.histogram('maxwindownotify_cube_connect_seconds',
+                                          'Time to open the TCP connection to the MAX Cube')
+_CUBE_FETCH_SECONDS = metrics.histogram('maxwindownotify_cube_fetch_seconds',
+                                        'Time to receive the MAX Cube data up to the L: line')
+_CUBE_DECODE_SECONDS = metrics.histogram('maxwindownotify_cube_decode_seconds',
+                                         'Time to decode the M: and L: lines of the MAX Cube data')
+_CUBE_RECEIVED_BYTES = metrics.counter('maxwindownotify_cube_received_bytes_total',
+                                       'Bytes received from the MAX Cube')
+_CUBE_FETCH_FAILURES = metrics.counter('maxwindownotify_cube_fetch_failures_total',
+                                       'Polls that did not receive any data from the MAX Cube')
+_DISCOVERY_SECONDS = metrics.histogram('maxwindownotify_discovery_seconds', 'Duration of the MAX Cube discovery')
+_DISCOVERY_FALLBACKS = metrics.counter('maxwindownotify_discovery_fallbacks_total',
+                                       'Discoveries that fell back to the tcp scan after the broadcast got no reply')
+_WEATHER_SECONDS = metrics.histogram('maxwindownotify_weather_request_seconds',
+                                     'Duration of the Open Weather Map requests')
+_WEATHER_CACHE = metrics.counter('maxwindownotify_weather_cache_total',
+                                 'Outside temperature lookups answered from the cache (hit) or the API (miss)',
+                                 ('result',))
+_OPEN_WINDOWS = metrics.gauge('maxwindownotify_open_windows', 'Number of open windows')
+_CYCLE_SECONDS = metrics.histogram('maxwindownotify_cycle_seconds', 'Duration of a poll cycle')
+_CYCLE_OVERRUNS = metrics.counter('maxwindownotify_cycle_overruns_total',
+                                  'Poll cycles that ran past the start of the next scheduled poll')
+_STAGE_OVERRUNS = metrics.counter('maxwindownotify_stage_overruns_total',
+                                  'Poll cycle stages cut short after running past their deadline', ('stage',))
+_WATCHDOG_RESTARTS = metrics.counter('maxwindownotify_watchdog_restarts_total',
+                                     'Poll cycles aborted by the watchdog after exceeding the cycle budget')
+_NOTIFIER_SEND_SECONDS = metrics.histogram('maxwindownotify_notifier_send_seconds',
+                                           'Time a notifier took to send a message or the batch of a poll cycle',
+                                           ('notifier',))
+
+
+def scan_for_cube(hosts, port, parallelism=64, timeout=0.5, deadline=None):
+    """
+    Concurrent TCP connect scan looking for a MAX Cube
+    :param hosts: iterable of IP addresses (strings or netaddr IPAddress objects) to probe
+    :param port: TCP port the MAX Cube listens on
+    :param parallelism: maximum number of connection attempts in flight at the same time
+    :param timeout: connect timeout per host in seconds
+    :param deadline: time (as returned by time.time()) the scan gives up at, None probes all hosts
+    :return: the IP of the first host accepting the connection as string, or None if no host answered
+    """
+    hosts = iter(hosts)
+    pending = {}
+    hosts_exhausted = False
+    cube_ip = None
+
+    try:
+        while cube_ip is None:
+            while not hosts_exhausted and len(pending) < parallelism:
+                try:
+                    ip = str(next(hosts))
+                except StopIteration:
+                    hosts_exhausted = True
+                    break
+                tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                tcp_socket.setblocking(0)
+                result = tcp_socket.connect_ex((ip, port))
+                if result == 0:
+                    tcp_socket.close()
+                    cube_ip = ip
+                    break
+                elif result in _CONNECT_IN_PROGRESS:
+                    pending[tcp_socket] = (ip, time.time() + timeout)
                 else:
-                    headers = {'Content-Type': 'application/json'}
+                    tcp_socket.close()
+
+            if cube_ip or not pending:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+
+            next_deadline = min(probe_deadline for ip, probe_deadline in pending.values())
+            if deadline is not None:
+                next_deadline = min(next_deadline, deadline)
+            wait = max(0, next_deadline - time.time())
+            _, writable, errored = select.select([], list(pending), list(pending), wait)
+
+            for tcp_socket in set(writable + errored):
+                ip = pending.pop(tcp_socket)[0]
+                if not cube_ip and tcp_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    cube_ip = ip
+                tcp_socket.close()
 
+            now = time.time()
+            for tcp_socket, (ip, probe_deadline) in list(pending.items()):
+                if probe_deadline <= now:
+                    del pending[tcp_socket]
+                    tcp_socket.close()
+    finally:
+        # cancel all probes still in flight
+        for tcp_socket in pending:
+            tcp_socket.close()
+
+    return cube_ip
+
+
+def subnet_list(discover_ip_subnet):
+    """
+    Normalizes the subnets to discover the MAX Cube in
+    :param discover_ip_subnet: a subnet as string, a comma separated string of subnets or a list of those
+    :return: a list of netaddr IPNetwork objects
+    """
+    if isinstance(discover_ip_subnet, basestring):
+        discover_ip_subnet = [discover_ip_subnet]
+
+    return [IPNetwork(subnet.strip()) for subnets in discover_ip_subnet for subnet in subnets.split(',')
+            if subnet.strip()]
+
+
+def disc_cubes_bcast(subnet_broadcasts, echo_port, collect_all=False, timeout=5):
+    """
+    Sends the MAX Cube discover broadcast to all subnets at once and collects the replies
+    :param subnet_broadcasts: list of broadcast addresses to send the Max CUBE discover hello to
+    :param echo_port: UDP port number for discover broadcast
+    :param collect_all: if set to 'True', all replies received until the timeout are collected,
+    otherwise the discovery returns with the first reply
+    :param timeout: time in seconds to wait for replies
+    :return: a list of (cube_data_dict, cube_ip) tuples with one entry per replying Max CUBE serial number
+    """
+    if isinstance(subnet_broadcasts, basestring):
+        subnet_broadcasts = [subnet_broadcasts]
+
+    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
+    udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    udp_socket.setblocking(0)
+
+    hello_data = '6551334d61782a002a2a2a2a2a2a2a2a2a2a49'.decode('hex')
+
+    try:
+        udp_socket.bind(('', echo_port))
+    except socket.error as e:
+        logging.log(logging.ERROR, 'Could not bind UDP port {} for the discovery, socket error is: {}'.format(
+            echo_port, e))
+        udp_socket.close()
+        return []
+
+    sent = 0
+    for subnet_broadcast in subnet_broadcasts:
+        try:
+            udp_socket.sendto(hello_data, (subnet_broadcast, echo_port))
+            sent += 1
+        except socket.error as e:
+            logging.log(logging.ERROR, 'Could not send UDP discover brodcast to {}, socket error is: {}'.format(
+                subnet_broadcast, e))
+    if not sent:
+        udp_socket.close()
+        return []
+
+    cubes = OrderedDict()
+    deadline = time.time() + timeout
+
+    while not cubes or collect_all:
+        wait = deadline - time.time()
+        if wait <= 0 or not select.select([udp_socket], [], [], wait)[0]:
+            break
+        try:
+            recv_data, recvaddr = udp_socket.recvfrom(4096)
+        except socket.error:
+            continue
+        # our own broadcast is received as well
+        if recv_data != hello_data:
+            cube_data_dict = {'generic_reponse': recv_data[:8],
+                              'serial_number': recv_data[9:18],
+                              'firmware_version': recv_data[-2:]}
+            cubes.setdefault(cube_data_dict['serial_number'], (cube_data_dict, recvaddr[0]))
+
+    if not cubes:
+        logging.log(logging.ERROR, 'No MAX Cube reacted to our subnet broadcast to {}'.format(
+            ', '.join(subnet_broadcasts)))
+    udp_socket.close()
+
+    return list(cubes.values())
+
+
+def load_state(state_file):
+    """
+    Loads a JSON state file written by save_state
+    :param state_file: path to the state file
+    :return: the stored data, or None if the file does not exist or can't be read
+    """
+    try:
+        with open(state_file) as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        logging.log(logging.DEBUG, 'could not read state file {}: {}'.format(state_file, e))
+        return None
+
+
+def save_state(state_file, data):
+    """
+    Atomically replaces a JSON state file, the directory is created if needed
+    :param state_file: path to the state file
+    :param data: the JSON serializable data to store
+    """
+    state_dir = os.path.dirname(state_file)
+    try:
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(state_file + '.tmp', state_file)
+    except (IOError, OSError) as e:
+        logging.log(logging.WARNING, 'could not write state file {}: {}'.format(state_file, e))
+
+
+class CaptureWriter:
+    def __init__(self, capture_dir):
+        """
+        Appends the raw Max CUBE data of every poll to a capture file, which can be fed back with --replay
+        :param capture_dir: directory the capture file is created in, the file is named after the start time
+        """
+        if not os.path.isdir(capture_dir):
+            os.makedirs(capture_dir)
+        self.capture_file = os.path.join(capture_dir, time.strftime('cube-%Y%m%d-%H%M%S.cap'))
+        self._file = open(self.capture_file, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(_CAPTURE_MAGIC)
+        self._lock = threading.Lock()
+        logging.log(logging.INFO, 'recording MAX Cube data to {}'.format(self.capture_file))
+
+    def write(self, cube_data, timestamp=None):
+        """
+        Appends one record
+        :param cube_data: the raw data received from the Max CUBE
+        :param timestamp: the time the data was received, defaults to now
+        """
+        record = _CAPTURE_RECORD.pack(timestamp or time.time(), len(cube_data)) + cube_data
+        with self._lock:
             try:
-                response = self._session.request(method, url, headers=headers, params=params, data=data)
-            except requests.exceptions.RequestException as e:
-                return OrderedDict([('status', 'connection exception'), ('body', e)])
+                self._file.write(record)
+                self._file.flush()
+            except IOError as e:
+                logging.log(logging.WARNING, 'could not write to capture file {}: {}'.format(self.capture_file, e))
+
+    def close(self):
+        self._file.close()
+
+
+def read_capture(capture_file):
+    """
+    Streams the records of a capture file written by CaptureWriter. The file is memory mapped and read record by
+    record, so captures larger than the memory can be replayed
+    :param capture_file: path to the capture file
+    :return: a generator of (timestamp, cube data) tuples
+    :raises ValueError: if the file is not a capture file
+    """
+    with open(capture_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(_CAPTURE_MAGIC):
+            raise ValueError('{} is not a MAX Cube capture file'.format(capture_file))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        if mapped[:len(_CAPTURE_MAGIC)] != _CAPTURE_MAGIC:
+            raise ValueError('{} is not a MAX Cube capture file'.format(capture_file))
+
+        offset = len(_CAPTURE_MAGIC)
+        size = len(mapped)
+        while offset + _CAPTURE_RECORD.size <= size:
+            timestamp, length = _CAPTURE_RECORD.unpack_from(mapped, offset)
+            offset += _CAPTURE_RECORD.size
+            if offset + length > size:
+                break
+            yield timestamp, mapped[offset:offset + length]
+            offset += length
+
+        if offset != size:
+            # e.g. the recording daemon was killed while writing
+            logging.log(logging.WARNING, 'capture file {} ends with a truncated record'.format(capture_file))
+    finally:
+        mapped.close()
+
+
+class DeviceStateTable:
+    # operating modes in the lowest two bits of flags_2
+    MODES = ('auto', 'manual', 'vacation', 'boost')
+
+    def __init__(self, rows=()):
+        """
+        Status of the devices of the L: line in columns of parallel arrays instead of an object per device. The rows
+        are sorted by rf address, so the row of a device is found by a binary search without an index of its own.
+        Temperatures are stored in tenths of a degree, values a device does not report are -1
+        :param rows: list of (rf address, flags_1, flags_2, valve position, setpoint, actual temperature) tuples
+        """
+        columns = zip(*sorted(rows)) or [()] * 6
+        self.rf_address = array.array('i', columns[0])
+        self.flags_1 = array.array('B', columns[1])
+        self.flags_2 = array.array('B', columns[2])
+        self.valve_position = array.array('b', columns[3])
+        self.setpoint = array.array('h', columns[4])
+        self.actual_temperature = array.array('h', columns[5])
 
-            response_content = response.content
+    def __len__(self):
+        return len(self.rf_address)
 
-            if response.status_code in [200]:
-                if 'Content-Type' in response.headers:
-                    if response.headers['Content-Type'].find('application/json') != -1:
-                        print response.content
-                        response_content = json.loads(response.content)
+    def __contains__(self, rf_address):
+        return self.row(rf_address) is not None
 
-            return OrderedDict([('status', response.status_code), ('body', response_content)])
+    def row(self, rf_address):
+        """
+        :param rf_address: the rf address of the device as int
+        :return: the row of the device in the arrays, or None if the device is not in the table
+        """
+        row = bisect.bisect_left(self.rf_address, rf_address)
+        if row < len(self.rf_address) and self.rf_address[row] == rf_address:
+            return row
+        return None
+
+    def get(self, rf_address):
+        """
+        Get the status of one device
+        :param rf_address: the rf address of the device as int
+        :return: a dict with the device status, temperatures in degrees and values the device does not report as
+        None, or None if the device is not in the table
+        """
+        row = self.row(rf_address)
+        if row is None:
+            return None
+
+        valve_position, setpoint, actual_temperature = \
+            self.valve_position[row], self.setpoint[row], self.actual_temperature[row]
+        return {'rf_address': rf_address,
+                'flags_1': self.flags_1[row],
+                'flags_2': self.flags_2[row],
+                # only thermostats have an operating mode
+                'mode': self.MODES[self.flags_2[row] & 0x03] if valve_position >= 0 else None,
+                'valve_position': valve_position if valve_position >= 0 else None,
+                'setpoint': setpoint / 10.0 if setpoint >= 0 else None,
+                'actual_temperature': actual_temperature / 10.0 if actual_temperature >= 0 else None}
+
+
+class BackgroundCall(threading.Thread):
+    def __init__(self, func, *args, **kwargs):
+        """
+        Runs a function in a daemon thread, the return value is available in 'result' and the runtime in seconds
+        in 'duration' once the thread is joined
+        :param func: the function to call, any further arguments are passed to it
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self.result = None
+        self.duration = None
+        self.started = time.time()
+        self.start()
+
+    def run(self):
+        start = time.time()
+        try:
+            self.result = self._func(*self._args, **self._kwargs)
+        except Exception as e:
+            logging.log(logging.ERROR, 'background call of {} failed: {}'.format(self._func.__name__, e))
+        self.duration = time.time() - start
 
 
 class MaxConnection:
-    def __init__(self, discover_ip_subnet='192.168.178.0/24', echo_port=23272, cube_port=62910):
+    def __init__(self, discover_ip_subnet='192.168.178.0/24', echo_port=23272, cube_port=62910, scan_parallelism=64,
+                 cube_ip=None, persistent=False, cube_data=None, discovery_cache=None, rediscover=False,
+                 rediscover_after=3, recorder=None, discover_timeout=None, fetch_timeout=None, decode_timeout=None,
+                 max_fallbacks=1):
         """
         Max CUBE discovery and connection handling object
-        :param discover_ip_subnet: Subnet to send the Max CUBE discover Broadcast to
+        :param discover_ip_subnet: Subnet to send the Max CUBE discover Broadcast to, several subnets can be
+        given as list or comma separated string
         :param echo_port: UDP port number for discover broadcast
         :param cube_port: TCP port for the connection to Max CUBE
+        :param scan_parallelism: number of concurrent connection attempts used by the tcp scan fallback
+        :param cube_ip: IP of the Max CUBE, if set the discovery is skipped
+        :param persistent: keep the TCP connection to the Max CUBE open between polls and only request
+        the device status list (L: line) instead of the full data dump
+        :param cube_data: dict with the Max CUBE details as returned by the discovery, used together with cube_ip
+        :param discovery_cache: path of a state file remembering the last discovered Max CUBE. If the cached
+        Max CUBE still accepts connections the discovery is skipped
+        :param rediscover: ignore the discovery cache and always run the full discovery
+        :param rediscover_after: number of consecutive failed polls after which the discovery is re-run in the
+        background, 0 disables the background discovery
+        :param recorder: CaptureWriter the raw data of every poll is recorded with, complete or not
+        :param discover_timeout: seconds the discovery may take before it gives up, None waits for the broadcast
+        replies and scans all hosts
+        :param fetch_timeout: seconds a poll may take to receive the data of the Max CUBE, the data received until
+        then is used if it is complete, otherwise the data of the last complete poll. None only limits each recv
+        :param decode_timeout: seconds the decoding of the data should take, longer decodes are counted as overrun
+        :param max_fallbacks: number of polls in a row the data of the last complete poll is used for when the Max
+        CUBE sends incomplete data, after that the polls fail until complete data arrives. 0 disables the fallback
         """
-        self.discover_ip_range = discover_ip_subnet
+        self.discover_ip_ranges = subnet_list(discover_ip_subnet)
         self.echo_port = echo_port
         self.cube_port = cube_port
-        self.cube_data, self.cube_ip = self.discover_cube()
+        self.scan_parallelism = scan_parallelism
+        self.discovery_cache = discovery_cache
+        self.rediscover_after = rediscover_after
+        self.recorder = recorder
+        self.discover_timeout = discover_timeout
+        self.fetch_timeout = fetch_timeout
+        self.decode_timeout = decode_timeout
+        self.max_fallbacks = max_fallbacks
+        self._last_cube_data = None
+        self._fallbacks = 0
+        self._fetch_failures = 0
+        self._rediscovery = None
+        self.persistent = persistent
+        self._cube_socket = None
+        self._cube_header_data = None
+        self._topology_key = None
+        self._window_index = None
+        self.device_rooms = {}
+        self.device_names = {}
+        self.room_names = {}
+        self.device_states = DeviceStateTable()
+        self.topology_cache_hits = 0
+        self.topology_cache_misses = 0
+        self._last_window_statis = {}
+        self._window_changes = []
+        if cube_ip:
+            self.cube_data, self.cube_ip = cube_data or {}, cube_ip
+        elif discovery_cache and not rediscover and self._load_discovery_cache():
+            logging.log(logging.INFO, 'using cached MAX Cube at {}'.format(self.cube_ip))
+        else:
+            self.cube_data, self.cube_ip = self.discover_cube()
+            if discovery_cache:
+                self._save_discovery_cache()
+
+    def _load_discovery_cache(self):
+        """
+        Revalidates the Max CUBE remembered in the discovery cache with a single connect
+        :return: True if the cached Max CUBE accepted the connection, cube_ip and cube_data are set in this case
+        """
+        cached = load_state(self.discovery_cache)
+        if not cached or not cached.get('cube_ip'):
+            return False
+
+        if not self._test_connect_to_cube(cached['cube_ip']):
+            logging.log(logging.INFO, 'cached MAX Cube at {} did not answer, running the discovery'.format(
+                cached['cube_ip']))
+            return False
+
+        self.cube_ip = str(cached['cube_ip'])
+        self.cube_data = dict((str(key), str(value).decode('hex')) for key, value in cached['cube_data'].items())
+        return True
+
+    def _save_discovery_cache(self):
+        cube_data = dict((key, value.encode('hex')) for key, value in (self.cube_data or {}).items())
+        save_state(self.discovery_cache, {'cube_ip': self.cube_ip, 'cube_data': cube_data})
 
     def discover_cube(self):
         """
@@ -104,14 +567,7 @@ class MaxConnection:
         [0] contains a dict with the CUBE details like verion, etc.,
         [1] contains the IP of the discovered Max CUBE
         """
-        subnet_broadcast = str(IPNetwork(self.discover_ip_range).broadcast)
-        subnet_host_list = IPNetwork(self.discover_ip_range).iter_hosts()
-        cube_data_dict, cube_ip = self._disc_cube_bcast(subnet_broadcast)
-
-        if not cube_ip:
-            logging.log(logging.WARNING, 'Could not find MAX Cube on the network through broadcast discovery, '
-                                         'retrying with ip range tcp scan, this may take a while')
-            cube_ip = self._disc_cube_ucast(subnet_host_list)
+        cube_data_dict, cube_ip = self._find_cube()
 
         if not cube_ip:
             logging.log(logging.ERROR, 'Could not find any MAX Cube on the network')
@@ -119,54 +575,70 @@ class MaxConnection:
 
         return cube_data_dict, cube_ip
 
-    def _disc_cube_bcast(self, subnet_broadcast):
-        udp_send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        udp_send_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-        udp_send_socket.settimeout(5)
-        udp_recv_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        udp_recv_socket.bind(('', self.echo_port))
-        udp_recv_socket.settimeout(5)
-
-        hello_data = '6551334d61782a002a2a2a2a2a2a2a2a2a2a49'.decode('hex')
+    def _find_cube(self):
+        start = _monotonic()
+        deadline = time.time() + self.discover_timeout if self.discover_timeout else None
+        subnet_broadcasts = [str(subnet.broadcast) for subnet in self.discover_ip_ranges]
+        subnet_host_list = itertools.chain.from_iterable(subnet.iter_hosts() for subnet in self.discover_ip_ranges)
+        cube_data_dict, cube_ip = self._disc_cube_bcast(subnet_broadcasts, deadline)
 
-        try:
-            udp_send_socket.sendto(hello_data, (subnet_broadcast, self.echo_port))
-        except (socket.timeout, socket.error) as e:
-            logging.log(logging.ERROR, 'Could not send UDP discover brodcast, socket error is: {}'.format(e))
-            return None, None
-
-        cube_data = None
-        cube_ip = None
-
-        while True:
-            try:
-                recv_data, recvaddr = udp_recv_socket.recvfrom(4096)
-                if recv_data != hello_data:
-                    cube_data, cube_ip = recv_data, recvaddr[0]
-                    break
-            except (socket.timeout, socket.error) as e:
-                udp_send_socket.close()
-                udp_recv_socket.close()
-                logging.log(logging.ERROR, 'No MAX Cube reacted to our subnet broadcast, socket error is: {}'.format(e))
-                return None, None
-
-        cube_data_dict = {}
-        if cube_data:
-            cube_data_dict.update({'generic_reponse': cube_data[:8]})
-            cube_data_dict.update({'serial_number': cube_data[9:18]})
-            cube_data_dict.update({'firmware_version': cube_data[-2:]})
-
-        udp_send_socket.close()
-        udp_recv_socket.close()
+        if not cube_ip:
+            logging.log(logging.WARNING, 'Could not find MAX Cube on the network through broadcast discovery, '
+                                         'retrying with ip range tcp scan, this may take a while')
+            _DISCOVERY_FALLBACKS.inc()
+            cube_ip = self._disc_cube_ucast(subnet_host_list, deadline)
+            if not cube_ip and deadline is not None and time.time() >= deadline:
+                _STAGE_OVERRUNS.inc(labels=('discover',))
+                logging.log(logging.WARNING, 'MAX Cube discovery gave up after {}s'.format(self.discover_timeout))
 
+        _DISCOVERY_SECONDS.observe(_monotonic() - start)
         return cube_data_dict, cube_ip
 
-    def _disc_cube_ucast(self, ip_range_list):
-        for ip in ip_range_list:
-            if self._test_connect_to_cube(str(ip)):
-                return str(ip)
+    def _rediscover_cube(self):
+        """
+        Runs the discovery again in the background after the Max CUBE could not be polled rediscover_after times
+        in a row, e.g. because it received a new IP through DHCP
+        """
+        cube_data_dict, cube_ip = self._find_cube()
+        if not cube_ip:
+            logging.log(logging.ERROR, 'background discovery could not find any MAX Cube on the network')
+            return
+
+        logging.log(logging.WARNING, 'background discovery found MAX Cube at {}'.format(cube_ip))
+        self.close()
+        self.cube_data, self.cube_ip = cube_data_dict or {}, cube_ip
+        self._fetch_failures = 0
+        if self.discovery_cache:
+            self._save_discovery_cache()
+
+    def _register_fetch_result(self, success):
+        if success:
+            self._fetch_failures = 0
+            return
+
+        self._fetch_failures += 1
+        if not self.rediscover_after or self._fetch_failures < self.rediscover_after:
+            return
+        if self._rediscovery and self._rediscovery.is_alive():
+            return
+
+        logging.log(logging.WARNING, 'MAX Cube could not be polled {} times in a row, starting background '
+                                     'discovery'.format(self._fetch_failures))
+        self._rediscovery = BackgroundCall(self._rediscover_cube)
+
+    def _disc_cube_bcast(self, subnet_broadcasts, deadline=None):
+        timeout = 5
+        if deadline is not None:
+            # leave half of the time to the tcp scan
+            timeout = min(timeout, max(0, deadline - time.time()) / 2)
+        cubes = disc_cubes_bcast(subnet_broadcasts, self.echo_port, timeout=timeout)
+        if not cubes:
+            return None, None
 
-        return None
+        return cubes[0]
+
+    def _disc_cube_ucast(self, ip_range_list, deadline=None):
+        return scan_for_cube(ip_range_list, self.cube_port, parallelism=self.scan_parallelism, deadline=deadline)
 
     def _test_connect_to_cube(self, ip):
         try:
@@ -180,164 +652,1338 @@ class MaxConnection:
             return None
 
     def _get_cube_data(self):
+        start = _monotonic()
+        deadline = start + self.fetch_timeout if self.fetch_timeout else None
+        if self.persistent and self._cube_socket:
+            l_line = self._get_cube_status_list(deadline)
+            if l_line:
+                _CUBE_FETCH_SECONDS.observe(_monotonic() - start)
+                _CUBE_RECEIVED_BYTES.inc(len(l_line))
+                return self._cube_header_data + l_line
+            logging.log(logging.WARNING, 'lost persistent connection to MAX Cube, reconnecting')
+
         tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tcp_socket.settimeout(3)
+        tcp_socket.settimeout(3 if deadline is None else max(0.001, min(3, deadline - _monotonic())))
 
+        start = _monotonic()
         try:
             tcp_socket.connect((self.cube_ip, self.cube_port))
         except (socket.timeout, socket.error) as e:
             logging.log(logging.ERROR, 'Could not open TCP connection to MAX Cube, socket error is: {}'.format(e))
             tcp_socket.close()
             return None
+        connected = _monotonic()
+        _CUBE_CONNECT_SECONDS.observe(connected - start)
 
-        received_data = b''
         logging.log(logging.INFO, 'connecting to MAX Cube to retrieve data')
-        while True:
-            try:
-                received_data += tcp_socket.recv(100000)
-            except (socket.timeout, socket.error):
-                tcp_socket.close()
-                break
-
-        tcp_socket.close()
+        tcp_socket.settimeout(3)
+        received_data = self._read_until_l_line(tcp_socket, deadline)
+        _CUBE_FETCH_SECONDS.observe(_monotonic() - connected)
+        _CUBE_RECEIVED_BYTES.inc(len(received_data))
+
+        header_data, l_line = self._split_l_line(received_data)
+        if self.persistent and l_line:
+            self._cube_socket = tcp_socket
+            self._cube_header_data = header_data
+        else:
+            tcp_socket.close()
 
         return received_data
 
+    def _get_cube_status_list(self, deadline=None):
+        """
+        Requests the device status list on the open persistent connection
+        :param deadline: time on the monotonic clock the L: line has to be received by
+        :return: the L: line, or None if the connection was lost or the L: line did not arrive in time
+        """
+        try:
+            self._cube_socket.sendall(b'l:\r\n')
+            l_line = self._split_l_line(self._read_until_l_line(self._cube_socket, deadline))[1]
+        except (socket.timeout, socket.error) as e:
+            logging.log(logging.WARNING, 'could not request device status from MAX Cube, '
+                                         'socket error is: {}'.format(e))
+            l_line = None
+
+        if not l_line:
+            self.close()
+
+        return l_line
+
+    @staticmethod
+    def _split_l_line(cube_data):
+        """
+        Splits the data received from the Max CUBE into everything before the L: line and the L: line itself
+        :return: Tuple, [0] the data before the L: line, [1] the L: line, or None if it was not received
+        """
+        if cube_data[:2] == b'L:':
+            l_line_start = 0
+        else:
+            l_line_start = cube_data.rfind(b'\r\nL:') + 2
+        if l_line_start == 1 or not cube_data.endswith(b'\r\n'):
+            return cube_data, None
+
+        return cube_data[:l_line_start], cube_data[l_line_start:]
+
+    def close(self):
+        """
+        Closes the persistent connection to the Max CUBE, the next poll will reconnect and read the full data
+        """
+        if self._cube_socket:
+            self._cube_socket.close()
+        self._cube_socket = None
+        self._cube_header_data = None
+
+    @staticmethod
+    def _read_until_l_line(tcp_socket, deadline=None):
+        """
+        Reads the data the MAX Cube sends (H:, M:, C: and L: lines, each terminated by CRLF) until
+        the L: line is complete, instead of waiting for the socket timeout
+        :param tcp_socket: the connected socket to the Max CUBE
+        :param deadline: time on the monotonic clock to stop reading at, even if data is still trickling in
+        :return: the received data up to and including the L: line, or the data received until the socket
+        was closed, timed out or the deadline passed
+        """
+        received_data = bytearray()
+        line_start = 0
+        socket_timeout = tcp_socket.gettimeout()
+        # True while the socket timeout is the time remaining until the deadline
+        deadline_timeout = False
+        try:
+            while True:
+                if deadline is not None:
+                    remaining = deadline - _monotonic()
+                    if remaining <= 0:
+                        _STAGE_OVERRUNS.inc(labels=('fetch',))
+                        logging.log(logging.WARNING, 'MAX Cube data did not arrive before the fetch deadline')
+                        break
+                    deadline_timeout = socket_timeout is None or remaining <= socket_timeout
+                    tcp_socket.settimeout(remaining if deadline_timeout else socket_timeout)
+                try:
+                    chunk = tcp_socket.recv(16384)
+                except (socket.timeout, socket.error) as e:
+                    if isinstance(e, socket.timeout) and deadline_timeout:
+                        # the timer of recv can expire just before the monotonic clock reaches the deadline
+                        _STAGE_OVERRUNS.inc(labels=('fetch',))
+                        logging.log(logging.WARNING, 'MAX Cube data did not arrive before the fetch deadline')
+                        break
+                    logging.log(logging.WARNING, 'MAX Cube data ended before the L: line, socket error is: '
+                                                 '{}'.format(e))
+                    break
+                if not chunk:
+                    break
+
+                received_data.extend(chunk)
+                line_end = received_data.find(b'\r\n', line_start)
+                while line_end != -1:
+                    if received_data[line_start:line_start + 2] == b'L:':
+                        return bytes(received_data[:line_end + 2])
+                    line_start = line_end + 2
+                    line_end = received_data.find(b'\r\n', line_start)
+        finally:
+            tcp_socket.settimeout(socket_timeout)
+
+        return bytes(received_data)
+
     def _read_cube_data_lines(self, cube_data):
-        m_line_dict = {}
-        l_line_dict = {}
+        window_index = None
+        device_states = None
 
         for line in cube_data.split(b'\r\n'):
             if line[:2] == b'M:':
-                m_line_dict = self._decode_m_line(line)
+                window_index = self._get_window_index(line)
             if line[:2] == b'L:':
-                l_line_dict = self._decode_l_line(line)
+                device_states = self._decode_l_line(line)
             if not line:
                 break
 
-        return m_line_dict, l_line_dict
+        return window_index, device_states or DeviceStateTable()
+
+    def _get_window_index(self, m_line):
+        """
+        Returns the window switches known to the Max CUBE and updates the room ids of all devices in device_rooms.
+        The M: line is only decoded again when its content changed since the last poll, otherwise the cached index
+        is returned
+        :param m_line: the M: line as received from the Max CUBE
+        :return: a dict with the window switch names by rf address, or None if the M: line could not be decoded
+        """
+        topology_key = hashlib.sha1(m_line.strip()).digest()
+        if topology_key == self._topology_key:
+            self.topology_cache_hits += 1
+            return self._window_index
+
+        self.topology_cache_misses += 1
+        try:
+            rooms_and_devices = self._decode_m_line(m_line)
+        except ValueError as e:
+            logging.log(logging.ERROR, 'Could not decode the M: line received from MAX Cube: {}'.format(e))
+            return None
+
+        self._window_index = dict((device['rf_address'], device['name']) for device in rooms_and_devices['devices']
+                                  if device['type'] == 4)
+        self.device_rooms = dict((device['rf_address'], device['room_id']) for device in rooms_and_devices['devices'])
+        self.device_names = dict((device['rf_address'], device['name']) for device in rooms_and_devices['devices'])
+        self.room_names = dict((room_id, room['name']) for room_id, room in rooms_and_devices['rooms'].items())
+        self._topology_key = topology_key
+
+        return self._window_index
 
     @staticmethod
     def _decode_m_line(m_line):
+        """
+        Decodes the rooms and devices metadata of the M: line
+        :param m_line: the M: line as received from the Max CUBE
+        :return: a dict with the rooms (by room id) and the devices, rf addresses are returned as int
+        :raises ValueError: if the M: line is truncated
+        """
         encoded = m_line.strip().split(b',', 2)[2]
-        decoded = BytesIO(base64.decodestring(encoded))
-
-        data = {}
-        decoded.read(2)     # This drops the first 2 bytes
-        data['room_count'] = ord(decoded.read(1))
-
-        data['rooms'] = {}
+        try:
+            raw = base64.b64decode(encoded)
+        except (TypeError, binascii.Error) as e:
+            raise ValueError('invalid base64 data: {}'.format(e))
+        decoded = memoryview(raw)
+        end = len(raw)
+        unpack_room = _M_ROOM.unpack_from
+        unpack_device = _M_DEVICE.unpack_from
+        unpack_byte = _BYTE.unpack_from
+
+        data = {'rooms': {}, 'devices': []}
+        offset = 2      # This drops the first 2 bytes
+        if offset + 1 > end:
+            raise ValueError('data ends before the room count')
+        data['room_count'] = _BYTE.unpack_from(decoded, offset)[0]
+        offset += 1
+
+        rooms = data['rooms']
         for i in range(data['room_count']):
-            room = {'id': ord(decoded.read(1)), 'name_len': ord(decoded.read(1))}
-            room['name'] = decoded.read(room['name_len'])
-            room['rf_address'] = binascii.b2a_hex(decoded.read(3))
-            data['rooms'][room['id']] = room
-
-        data['devices_count'] = ord(decoded.read(1))
-        data['devices'] = []
+            if offset + _M_ROOM.size > end:
+                raise ValueError('data ends in the header of room {} of {}'.format(i + 1, data['room_count']))
+            room_id, name_len = unpack_room(decoded, offset)
+            name_start = offset + _M_ROOM.size
+            offset = name_start + name_len + 3
+            if offset > end:
+                raise ValueError('data ends in room {} of {}'.format(i + 1, data['room_count']))
+            rf_high, rf_low = struct.unpack_from('>BH', decoded, offset - 3)
+            rooms[room_id] = {'id': room_id, 'name_len': name_len, 'name': raw[name_start:offset - 3],
+                              'rf_address': rf_high << 16 | rf_low}
+
+        if offset + 1 > end:
+            raise ValueError('data ends before the device count')
+        data['devices_count'] = _BYTE.unpack_from(decoded, offset)[0]
+        offset += 1
+
+        devices = data['devices']
         for i in range(data['devices_count']):
-            device = {'type': ord(decoded.read(1)), 'rf_address': binascii.b2a_hex(decoded.read(3)),
-                      'serial': decoded.read(10), 'name_len': ord(decoded.read(1))}
-            device['name'] = decoded.read(device['name_len'])
-            device['room_id'] = ord(decoded.read(1))
-            data['devices'].append(device)
-
-        decoded.read(1)     # This drops the last bytes
+            if offset + _M_DEVICE.size > end:
+                raise ValueError('data ends in the header of device {} of {}'.format(i + 1, data['devices_count']))
+            device_type, rf_high, rf_low, serial, name_len = unpack_device(decoded, offset)
+            name_start = offset + _M_DEVICE.size
+            offset = name_start + name_len + 1
+            if offset > end:
+                raise ValueError('data ends in device {} of {}'.format(i + 1, data['devices_count']))
+            devices.append({'type': device_type, 'rf_address': rf_high << 16 | rf_low, 'serial': serial,
+                            'name_len': name_len, 'name': raw[name_start:offset - 1],
+                            'room_id': unpack_byte(decoded, offset - 1)[0]})
 
         return data
 
     @staticmethod
     def _decode_l_line(l_line):
+        """
+        Decodes the device status list of the L: line, including the valve position, setpoint and actual
+        temperature reported by heating and wall thermostats
+        :param l_line: the L: line as received from the Max CUBE
+        :return: a DeviceStateTable with the devices by rf address as int. A truncated last record is dropped
+        """
         encoded = l_line.strip()[2:]
-        decoded = BytesIO(base64.decodestring(encoded))
-        data = {}
-        while True:
-            device = {}
-            try:
-                device['len'] = ord(decoded.read(1))
-            except TypeError:
+        # only complete base64 quads are decoded, a truncated record is detected below
+        raw = base64.b64decode(encoded[:len(encoded) // 4 * 4])
+        decoded = memoryview(raw)
+        # the record lengths are read by index, which is cheaper than unpacking them
+        raw_bytes = bytearray(raw)
+        end = len(raw)
+        unpack_record = _L_RECORD.unpack_from
+        unpack_thermostat = _L_THERMOSTAT_RECORD.unpack_from
+        record_size = _L_RECORD.size
+
+        rows = []
+        append = rows.append
+        offset = 0
+        while offset < end:
+            length = None
+            if offset + record_size <= end:
+                length = raw_bytes[offset]
+            if length is None or length < record_size - 1 or offset + 1 + length > end:
+                logging.log(logging.WARNING, 'L: line received from MAX Cube is truncated at byte {} of {}, '
+                                             'dropping the last device status'.format(offset, end))
                 break
-            device['rf_address'] = binascii.b2a_hex(decoded.read(3))
-            decoded.read(1)  # Drop unknown byte
-            device['flags_1'] = ord(decoded.read(1))
-            device['flags_2'] = ord(decoded.read(1))
-            if device['len'] > 6:
-                decoded.read(device['len'] - 6)  # Drop the data, those are all not Window Switches
-            data[device['rf_address']] = device
-        return data
+            if length < 10:
+                # window switches and eco buttons only report the flags
+                length, rf_high, rf_low, flags_1, flags_2 = unpack_record(decoded, offset)
+                append((rf_high << 16 | rf_low, flags_1, flags_2, -1, -1, -1))
+            else:
+                length, rf_high, rf_low, flags_1, flags_2, valve_position, setpoint, date_high, date_low = \
+                    unpack_thermostat(decoded, offset)
+                if length >= 12:
+                    # wall thermostats keep the 9th bit of the actual temperature in the setpoint byte
+                    actual_temperature = (setpoint & 0x80) << 1 | raw_bytes[offset + 12]
+                elif flags_2 & 0x03 != 2:
+                    # heating thermostats report the actual temperature unless they are in vacation mode
+                    actual_temperature = (date_high & 0x01) << 8 | date_low
+                else:
+                    actual_temperature = -1
+                append((rf_high << 16 | rf_low, flags_1, flags_2, valve_position, (setpoint & 0x7f) * 5,
+                        actual_temperature or -1))
+            offset += 1 + length
 
-    def window_switch_status(self, simulation_mode=False):
+        return DeviceStateTable(rows)
+
+    def window_switch_status(self, simulation_mode=False, cube_data=None):
         """
         Get the current status of all window sensors the Max CUBE knows about
         :param simulation_mode: If simulation mode is set to 'true',
         each call will randomly alter one of the windows to be 'open'
+        :param cube_data: raw Max CUBE data to decode instead of polling the Max CUBE, e.g. from a capture file
         :return: a dict with all windows sensors and their status
         """
         windows_switch_dict = {}
 
-        cube_data = self._get_cube_data()
+        if cube_data is None:
+            cube_data = self._get_cube_data()
+            # incomplete data is recorded as well, it is what a replay has to reproduce
+            if cube_data and self.recorder:
+                self.recorder.write(cube_data)
+            complete = bool(cube_data) and self._split_l_line(cube_data)[1] is not None
+            self._register_fetch_result(complete)
+            if complete:
+                self._last_cube_data = cube_data
+                self._fallbacks = 0
+            elif cube_data:
+                # without the L: line all windows would be reported as closed, and the data of the last complete
+                # poll is only trusted for a limited number of polls
+                if self._last_cube_data and self._fallbacks < self.max_fallbacks:
+                    self._fallbacks += 1
+                    logging.log(logging.WARNING, 'incomplete data from MAX Cube, falling back to the data of the '
+                                                 'last complete poll')
+                    cube_data = self._last_cube_data
+                else:
+                    logging.log(logging.ERROR, 'incomplete data from MAX Cube, the data of the last complete poll '
+                                               'is too old to be used')
+                    cube_data = None
 
         if not cube_data:
+            _CUBE_FETCH_FAILURES.inc()
             logging.log(logging.ERROR, 'Did not receive data from MAX Cube')
             return None
 
-        rooms_and_devices, device_statis = self._read_cube_data_lines(cube_data)
-
-        for device in rooms_and_devices['devices']:
-            if device['type'] == 4:
-                windows_switch_dict.update({device['rf_address']: {'rf_address': device['rf_address'],
-                                                                   'name': device['name'],
-                                                                   'status': 'closed'}})
-        for device in device_statis:
-            if device in [rf_addr for rf_addr in windows_switch_dict]:
-                if device_statis[device]['flags_2'] & 2 == 2:
-                    windows_switch_dict[device]['status'] = 'open'
-                else:
-                    windows_switch_dict[device]['status'] = 'closed'
-
-        if simulation_mode:
+        start = _monotonic()
+        window_index, device_states = self._read_cube_data_lines(cube_data)
+        decode_duration = _monotonic() - start
+        _CUBE_DECODE_SECONDS.observe(decode_duration)
+        if self.decode_timeout and decode_duration > self.decode_timeout:
+            # the decoding can't be interrupted, its result is still used
+            _STAGE_OVERRUNS.inc(labels=('decode',))
+            logging.log(logging.WARNING, 'decoding the MAX Cube data took {:.3f}s, longer than the deadline of '
+                                         '{}s'.format(decode_duration, self.decode_timeout))
+
+        if window_index is None:
+            logging.log(logging.ERROR, 'Did not receive the rooms and devices list from MAX Cube')
+            return None
+        self.device_states = device_states
+
+        flags_2 = device_states.flags_2
+        device_rooms = self.device_rooms
+        room_names = self.room_names
+        heating_rooms = self._heating_rooms(device_states)
+        for rf_address, name in window_index.items():
+            row = device_states.row(rf_address)
+            if row is not None and flags_2[row] & 2 == 2:
+                status = 'open'
+            else:
+                status = 'closed'
+            room_id = device_rooms.get(rf_address)
+            windows_switch_dict[rf_address] = {'rf_address': rf_address, 'name': name, 'status': status,
+                                               'room_id': room_id, 'room': room_names.get(room_id),
+                                               'heating': room_id in heating_rooms}
+
+        if simulation_mode and windows_switch_dict:
             windows_switch_dict[random.choice([item for item in windows_switch_dict])]['status'] = 'open'
 
+        last_window_statis = self._last_window_statis
+        window_statis = {}
+        self._window_changes = []
+        for rf_address, window in windows_switch_dict.items():
+            window_statis[rf_address] = window['status']
+            old_status = last_window_statis.pop(rf_address, None)
+            if old_status != window['status']:
+                self._window_changes.append((rf_address, old_status, window['status']))
+        for rf_address, old_status in last_window_statis.items():
+            self._window_changes.append((rf_address, old_status, None))
+        self._last_window_statis = window_statis
+
+        return windows_switch_dict
+
+    def _heating_rooms(self, device_states):
+        """
+        :param device_states: the DeviceStateTable of the last poll
+        :return: set of the ids of the rooms with an open radiator valve, devices without a room (id 0) are ignored
+        """
+        device_rooms = self.device_rooms
+        return set(device_rooms[rf_address] for rf_address, valve_position
+                   in itertools.izip(device_states.rf_address, device_states.valve_position)
+                   if valve_position > 0 and device_rooms.get(rf_address))
+
+    def device_status(self):
+        """
+        Get the status of all devices reported by the last successful call of window_switch_status
+        :return: list of dicts as returned by DeviceStateTable.get, with the name and room of each device
+        """
+        devices = []
+        for rf_address in self.device_states.rf_address:
+            device = self.device_states.get(rf_address)
+            room_id = self.device_rooms.get(rf_address)
+            device.update(name=self.device_names.get(rf_address), room_id=room_id, room=self.room_names.get(room_id))
+            devices.append(device)
+        return devices
+
+    def window_status_changes(self):
+        """
+        Get the window status changes between the last two successful calls of window_switch_status
+        :return: a generator of (rf_address, old_status, new_status) tuples, old_status is None for windows
+        seen the first time and new_status is None for windows the Max CUBE no longer knows about
+        """
+        for change in self._window_changes:
+            yield change
+
+
+class MaxCubeGroup:
+    def __init__(self, discover_ip_subnet='192.168.178.0/24', echo_port=23272, cube_port=62910, persistent=False,
+                 discover_timeout=None, fetch_timeout=None, decode_timeout=None):
+        """
+        Discovers all Max CUBEs answering the discover broadcast and polls them together
+        :param discover_ip_subnet: Subnet to send the Max CUBE discover Broadcast to, several subnets can be
+        given as list or comma separated string
+        :param echo_port: UDP port number for discover broadcast
+        :param cube_port: TCP port for the connection to Max CUBE
+        :param persistent: keep the TCP connections to the Max CUBEs open between polls
+        :param discover_timeout: seconds to collect discover replies, at most 5
+        :param fetch_timeout: seconds each Max CUBE may take to send its data, see MaxConnection
+        :param decode_timeout: seconds the decoding of the data of each Max CUBE should take, see MaxConnection
+        """
+        subnet_broadcasts = [str(subnet.broadcast) for subnet in subnet_list(discover_ip_subnet)]
+        self.cubes = OrderedDict()
+        for cube_data_dict, cube_ip in disc_cubes_bcast(subnet_broadcasts, echo_port, collect_all=True,
+                                                        timeout=min(5, discover_timeout or 5)):
+            logging.log(logging.INFO, 'found MAX Cube {} at {}'.format(cube_data_dict['serial_number'], cube_ip))
+            self.cubes[cube_data_dict['serial_number']] = MaxConnection(cube_port=cube_port, cube_ip=cube_ip,
+                                                                        persistent=persistent,
+                                                                        cube_data=cube_data_dict,
+                                                                        rediscover_after=0,
+                                                                        fetch_timeout=fetch_timeout,
+                                                                        decode_timeout=decode_timeout)
+
+        if not self.cubes:
+            logging.log(logging.ERROR, 'Could not find any MAX Cube on the network')
+            sys.exit()
+
+        self._window_changes = []
+
+    @property
+    def topology_cache_hits(self):
+        return sum(cube.topology_cache_hits for cube in self.cubes.values())
+
+    @property
+    def topology_cache_misses(self):
+        return sum(cube.topology_cache_misses for cube in self.cubes.values())
+
+    def window_switch_status(self, simulation_mode=False):
+        """
+        Get the current status of all window sensors of all Max CUBEs, the Max CUBEs are polled in parallel
+        :param simulation_mode: If simulation mode is set to 'true',
+        each call will randomly alter one of the windows of each Max CUBE to be 'open'
+        :return: a dict with all windows sensors and their status by (cube serial number, rf_address), or None if
+        no Max CUBE returned data
+        """
+        polls = [(serial, BackgroundCall(cube.window_switch_status, simulation_mode))
+                 for serial, cube in self.cubes.items()]
+
+        windows_switch_dict = None
+        self._window_changes = []
+        for serial, poll in polls:
+            poll.join()
+            if poll.result is None:
+                logging.log(logging.ERROR, 'Did not receive data from MAX Cube {}'.format(serial))
+                continue
+            if windows_switch_dict is None:
+                windows_switch_dict = {}
+            for rf_address, window in poll.result.items():
+                window['cube'] = serial
+                windows_switch_dict[(serial, rf_address)] = window
+            self._window_changes.extend(((serial, rf_address), old_status, new_status) for rf_address, old_status,
+                                        new_status in self.cubes[serial].window_status_changes())
+
         return windows_switch_dict
 
+    def device_status(self):
+        """
+        Get the status of the devices of all Max CUBEs as of their last successful poll
+        :return: list of dicts as returned by MaxConnection.device_status, with the serial number of the Max CUBE
+        """
+        devices = []
+        for serial, cube in self.cubes.items():
+            for device in cube.device_status():
+                device['cube'] = serial
+                devices.append(device)
+        return devices
+
+    def window_status_changes(self):
+        """
+        Get the window status changes of all Max CUBEs found by the last call of window_switch_status
+        :return: a generator of ((cube serial number, rf_address), old_status, new_status) tuples
+        """
+        for change in self._window_changes:
+            yield change
+
+    def close(self):
+        for cube in self.cubes.values():
+            cube.close()
+
 
 class OpenWeatherMap:
-    def __init__(self, appkey, apiurl='http://api.openweathermap.org/data/2.5/weather', debug=False):
+    def __init__(self, appkey, apiurl='http://api.openweathermap.org/data/2.5/weather', debug=False, cache_ttl=600,
+                 max_staleness=3600, cache_size=64, groupurl='http://api.openweathermap.org/data/2.5/group',
+                 max_parallel=8, session=None):
         """
         Object handling the session with the Open Weather Map API to retrieve the temperature of a location
         :param appkey: The APPID key for the OpenWeatherMap API.
         See openweathermap.org to register and get the APPID Key
         :param apiurl: The URL to retrieve the temperature, defaults to 'http://api.openweathermap.org/data/2.5/weather'
         :param debug: sends HTTPLIB debug output to stdout if set to 'True'
+        :param cache_ttl: time in seconds a retrieved temperature is used without asking the API again
+        :param max_staleness: time in seconds an expired temperature is still returned while it is refreshed in
+        the background, or when the API can't be reached
+        :param cache_size: maximum number of locations kept in the cache
+        :param groupurl: The URL to retrieve the temperature of several city IDs at once, defaults to
+        'http://api.openweathermap.org/data/2.5/group'
+        :param max_parallel: maximum number of concurrent requests of get_current_temperatures
+        :param session: the Session used for the requests, a new one is created if not set
         """
         self.appkey = appkey
         self.apiurl = apiurl
-        self._session = Session(debug=debug)
+        self.groupurl = groupurl
+        self.max_parallel = max_parallel
+        self._session = session or Session(debug=debug, pool_maxsize=max_parallel)
+        self.cache_ttl = cache_ttl
+        self.max_staleness = max_staleness
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._refreshes = {}
 
     def get_current_temperature(self, city, units='metric'):
         """
-        retrieves the current temperature of a location
+        retrieves the current temperature of a location. Cached temperatures younger than cache_ttl are returned
+        right away, expired ones younger than max_staleness are returned while being refreshed in the background
         :param city: The City name, code or ID as known in Open Weather Map
         :param units: The measurement unit, defaults to 'metric'.
         Can also be set to 'kelvin' or 'imperial' for fahrenheit
         :return: returns the temperature of the location as float, or None if an error occurred.
         """
+        cache_key = (city, units)
+        with self._cache_lock:
+            cached = self._cache.get(cache_key)
+
+        if cached:
+            temperature, retrieved = cached
+            age = time.time() - retrieved
+            if age < self.max_staleness:
+                self.cache_hits += 1
+                _WEATHER_CACHE.inc(labels=('hit',))
+                if age >= self.cache_ttl:
+                    self._refresh_temperature(city, units)
+                return temperature
+
+        self.cache_misses += 1
+        _WEATHER_CACHE.inc(labels=('miss',))
+        return self._retrieve_temperature(city, units)
+
+    def get_current_temperatures(self, cities, units='metric', max_age=None):
+        """
+        retrieves the current temperature of several locations. Each location is only looked up once, numeric city
+        IDs are retrieved in batches through the group endpoint, all other locations with concurrent requests
+        :param cities: list of City names, codes or IDs as known in Open Weather Map
+        :param units: The measurement unit, defaults to 'metric'.
+        Can also be set to 'kelvin' or 'imperial' for fahrenheit
+        :param max_age: time in seconds a cached temperature is used without asking the API again, defaults to
+        cache_ttl. A shorter max_age refreshes the cache ahead of the expiry of its temperatures
+        :return: returns a dict with the temperature as float by location, the temperature is None if an error
+        occurred for the location
+        """
+        max_age = self.cache_ttl if max_age is None else max_age
+        temperatures = OrderedDict((city, None) for city in cities)
+        city_ids = []
+        city_names = []
+        refreshes = []
+        for city in temperatures:
+            with self._cache_lock:
+                cached = self._cache.get((city, units))
+            age = time.time() - cached[1] if cached else None
+            if cached and age < max_age:
+                self.cache_hits += 1
+                _WEATHER_CACHE.inc(labels=('hit',))
+                temperatures[city] = cached[0]
+            elif str(city).isdigit():
+                city_ids.append(city)
+            elif cached and age < self.cache_ttl:
+                # not expired yet, get_current_temperature would return it without asking the API
+                refreshes.append(city)
+            else:
+                city_names.append(city)
+
+        lookups = [(city_ids[i:i + 20], self._retrieve_group_temperatures) for i in range(0, len(city_ids), 20)]
+        lookups.extend((city, self.get_current_temperature) for city in city_names)
+        lookups.extend((city, self._retrieve_temperature) for city in refreshes)
+        for i in range(0, len(lookups), self.max_parallel):
+            calls = [(argument, BackgroundCall(lookup, argument, units))
+                     for argument, lookup in lookups[i:i + self.max_parallel]]
+            for argument, call in calls:
+                call.join()
+                if isinstance(argument, list):
+                    temperatures.update(call.result or {})
+                else:
+                    temperatures[argument] = call.result
+
+        return temperatures
+
+    def _retrieve_group_temperatures(self, city_ids, units):
+        self.cache_misses += len(city_ids)
+        _WEATHER_CACHE.inc(len(city_ids), labels=('miss',))
+        params = {'id': ','.join(str(city_id) for city_id in city_ids), 'APPID': self.appkey, 'units': units}
+        start = _monotonic()
+        response = self._session.do_request('GET', self.groupurl, params=params)
+        _WEATHER_SECONDS.observe(_monotonic() - start)
+
+        try:
+            retrieved = dict((str(city['id']), city['main']['temp']) for city in response['body']['list'])
+        except (TypeError, AttributeError, KeyError):
+            logging.log(logging.ERROR, 'current temperatures for {} not received, status code was {}, response body '
+                                       'was {}'.format(params['id'], response['status'], response['body']))
+            retrieved = {}
+
+        temperatures = {}
+        for city_id in city_ids:
+            temperature = retrieved.get(str(city_id))
+            if temperature is not None:
+                self._cache_temperature((city_id, units), temperature)
+            else:
+                # fall back to an outdated temperature within max_staleness
+                with self._cache_lock:
+                    cached = self._cache.get((city_id, units))
+                if cached and time.time() - cached[1] < self.max_staleness:
+                    temperature = cached[0]
+            temperatures[city_id] = temperature
+
+        return temperatures
+
+    def _refresh_temperature(self, city, units):
+        with self._cache_lock:
+            refresh = self._refreshes.get((city, units))
+            if refresh and refresh.is_alive():
+                return
+            self._refreshes[(city, units)] = BackgroundCall(self._retrieve_temperature, city, units)
+
+    def _retrieve_temperature(self, city, units):
         params = {'q': city, 'APPID': self.appkey, 'units': units}
+        start = _monotonic()
         response = self._session.do_request('GET', self.apiurl, params=params)
+        _WEATHER_SECONDS.observe(_monotonic() - start)
 
         try:
             temperature = response['body']['main']['temp']
-            return temperature
-        except (TypeError, AttributeError):
+        except (TypeError, AttributeError, KeyError):
             logging.log(logging.ERROR, 'current temperature for {} not received, status code was {}, response body '
                                        'was {}'.format(city, response['status'], response['body']))
+            # fall back to an outdated temperature within max_staleness
+            with self._cache_lock:
+                cached = self._cache.get((city, units))
+            if cached and time.time() - cached[1] < self.max_staleness:
+                return cached[0]
             return None
 
+        self._cache_temperature((city, units), temperature)
+        return temperature
+
+    def _cache_temperature(self, cache_key, temperature):
+        now = time.time()
+        with self._cache_lock:
+            self._cache.pop(cache_key, None)
+            self._cache[cache_key] = (temperature, now)
+            # entries are ordered by retrieval time, the oldest ones are evicted first
+            for key, (cached_temperature, retrieved) in list(self._cache.items()):
+                if len(self._cache) <= self.cache_size and now - retrieved < self.max_staleness:
+                    break
+                del self._cache[key]
+
+
+class NotificationState:
+    def __init__(self, notify_after, renotify_every=3600, max_notifications=20, per_seconds=3600, state_file=None):
+        """
+        Table of the open windows keeping track of when they opened and when they were last notified
+        :param notify_after: time in seconds a window has to be open before the first notification
+        :param renotify_every: time in seconds between the following notifications while the window stays open,
+        0 only notifies once
+        :param max_notifications: global limit of notifications within per_seconds, enforced as token bucket
+        :param per_seconds: the period of max_notifications in seconds
+        :param state_file: JSON file the table is kept in, so it survives a restart
+        """
+        self.notify_after = notify_after
+        self.renotify_every = renotify_every
+        self.max_notifications = max_notifications
+        self.state_file = state_file
+        self._refill_rate = float(max_notifications) / per_seconds
+        self._tokens = float(max_notifications)
+        self._tokens_updated = time.time()
+        self._windows = {}
+        self._changed = False
+
+        for key, opened, last_notified in (load_state(state_file) if state_file else None) or []:
+            self._windows[tuple(key) if isinstance(key, list) else key] = [opened, last_notified]
+
+    def window_opened(self, key, now=None):
+        """
+        Records a window as open, a window already in the table keeps its original opening time
+        """
+        if key not in self._windows:
+            self._windows[key] = [now or time.time(), None]
+            self._changed = True
+
+    def opened(self, key):
+        """
+        :return: the time the window was recorded as open, or None if it is not open
+        """
+        window = self._windows.get(key)
+        return window[0] if window else None
+
+    def window_closed(self, key):
+        if self._windows.pop(key, None):
+            self._changed = True
+
+    def retain(self, keys):
+        """
+        Removes all windows not in keys, e.g. windows the Max CUBE no longer knows about after a restart
+        """
+        for key in list(self._windows):
+            if key not in keys:
+                self.window_closed(key)
+
+    def due(self, now=None, eligible=None):
+        """
+        Get the windows to notify now and mark them as notified. Windows exceeding the global rate limit stay due
+        for the next call
+        :param eligible: function called with (key, seconds the window is open) for each window that would be
+        due, windows it returns False for are not notified
+        :return: list of (key, seconds the window is open) tuples
+        """
+        now = now or time.time()
+        # max() keeps the bucket intact when replayed captures go back in time
+        self._tokens = min(self.max_notifications,
+                           self._tokens + max(0, now - self._tokens_updated) * self._refill_rate)
+        self._tokens_updated = now
+
+        due_windows = []
+        for key, window in sorted(self._windows.items(), key=lambda item: item[1][0]):
+            opened, last_notified = window
+            if last_notified is None:
+                if now - opened < self.notify_after:
+                    continue
+            elif not self.renotify_every or now - last_notified < self.renotify_every:
+                continue
+            if eligible and not eligible(key, now - opened):
+                continue
+
+            if self._tokens < 1:
+                logging.log(logging.WARNING, 'notification rate limit of {} reached, delaying notifications'.format(
+                    self.max_notifications))
+                break
+            self._tokens -= 1
+            window[1] = now
+            self._changed = True
+            due_windows.append((key, now - opened))
+
+        return due_windows
+
+    def save(self):
+        if self.state_file and self._changed:
+            save_state(self.state_file, [[key, opened, last_notified] for key, (opened, last_notified)
+                                         in self._windows.items()])
+            self._changed = False
+
+
+class PollScheduler:
+    def __init__(self, interval, fast_interval, max_interval, jitter=0.1):
+        """
+        Adaptive poll schedule: while a window is open or it is cold outside the Max CUBE is polled every
+        fast_interval, otherwise the interval starts at interval and doubles on every idle poll up to max_interval.
+        The deadlines are kept on a monotonic clock so the sleeps don't accumulate drift, and a delay is never longer
+        than max_interval plus jitter
+        :param interval: the regular polling interval in seconds
+        :param fast_interval: the polling interval in seconds while a window is open or it is cold outside
+        :param max_interval: the longest polling interval in seconds when idle
+        :param jitter: random fraction the intervals are stretched or shortened by, so several daemons don't
+        poll in lock step
+        """
+        self.interval = interval
+        self.fast_interval = min(fast_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.jitter = jitter
+        self._idle_interval = interval
+        self._next_deadline = _monotonic()
+        self.overruns = 0
+
+    def next_delay(self, active):
+        """
+        Schedules the next poll
+        :param active: True if a window is open or the temperature is below the threshold
+        :return: the time in seconds to sleep until the next poll
+        """
+        if active:
+            period = self.fast_interval
+            self._idle_interval = self.interval
+        else:
+            period = self._idle_interval
+            self._idle_interval = min(self._idle_interval * 2, self.max_interval)
+
+        self._next_deadline += period * (1 + random.uniform(-self.jitter, self.jitter))
+        now = _monotonic()
+        # after an overrun the schedule restarts from now instead of polling in a burst to catch up
+        if self._next_deadline < now:
+            self.overruns += 1
+            _CYCLE_OVERRUNS.inc()
+            self._next_deadline = now
+        # on the wall clock fallback a clock stepped backwards would stretch the delay by the size of the step
+        longest = self.max_interval * (1 + self.jitter)
+        if self._next_deadline - now > longest:
+            self._next_deadline = now + longest
+
+        return self._next_deadline - now
+
+    def shift(self, offset):
+        """
+        Moves the whole schedule, used to spread the polls of several Max CUBEs over the interval
+        :param offset: time in seconds to move the schedule by
+        :return: the monotonic time of the first poll
+        """
+        self._next_deadline += offset
+        return self._next_deadline
+
+
+class CycleTimeout(BaseException):
+    """
+    Raised in the main thread by the watchdog of CycleBudget. Derived from BaseException like KeyboardInterrupt, so
+    the 'except Exception' handlers of the stages don't swallow it
+    """
+
+
+class CycleBudget:
+    def __init__(self, budget, deadlines=None):
+        """
+        Time budget of a poll cycle and the deadlines of its stages. The watchdog raises CycleTimeout in the main
+        thread when a cycle exceeds the budget, which also interrupts blocking calls, so a hanging stage can't stop
+        the poll loop. The watchdog uses SIGALRM and is disabled on platforms without it
+        :param budget: seconds a whole cycle may take, 0 disables the watchdog
+        :param deadlines: dict of the deadlines in seconds by stage, overriding STAGE_DEADLINES
+        """
+        self.budget = budget
+        self.deadlines = OrderedDict(STAGE_DEADLINES)
+        self.deadlines.update(deadlines or {})
+        self.restarts = 0
+        self._armed = False
+        self.watchdog = bool(budget) and hasattr(signal, 'setitimer')
+        if self.watchdog:
+            signal.signal(signal.SIGALRM, self._expired)
+
+    def _expired(self, signum, frame):
+        # the timer may fire right before it is disarmed
+        if self._armed:
+            raise CycleTimeout('poll cycle exceeded its budget of {}s'.format(self.budget))
+
+    def arm(self):
+        """
+        Starts the watchdog for the next cycle
+        """
+        if self.watchdog:
+            self._armed = True
+            signal.setitimer(signal.ITIMER_REAL, self.budget)
+
+    def disarm(self):
+        if self.watchdog:
+            self._armed = False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def restarted(self):
+        """
+        Counts a cycle aborted by the watchdog
+        """
+        self.restarts += 1
+        _WATCHDOG_RESTARTS.inc()
+
+    def wait(self, stage, call):
+        """
+        Waits for the BackgroundCall running a stage until the deadline of the stage, counted from the start of the
+        call. A call still running then is abandoned and counted as overrun
+        :param stage: the name of the stage
+        :param call: the BackgroundCall running the stage
+        :return: True if the call finished in time
+        """
+        call.join(max(0, self.deadlines[stage] - (time.time() - call.started)))
+        if call.is_alive():
+            _STAGE_OVERRUNS.inc(labels=(stage,))
+            logging.log(logging.WARNING, '{} stage did not finish within its deadline of {}s'.format(
+                stage, self.deadlines[stage]))
+            return False
+        return True
+
+
+class FleetSite:
+    def __init__(self, name, max_cube, notifiers, weather, city, threshold, notifications, scheduler, rules=None):
+        """
+        One Max CUBE supervised in fleet mode, with its own settings and notification table
+        :param name: name of the site used in the log and the notifications
+        :param max_cube: the MaxConnection of the site
+        :param notifiers: list of Notifier objects the notifications of the site are sent with
+        :param weather: the OpenWeatherMap object, shared by all sites, None to not look up the outside temperature
+        :param city: the city name or code in OpenWeatherMap to retrieve the outside temperature from
+        :param threshold: the temperature threshold for suppressing notifications
+        :param notifications: the NotificationState of the site
+        :param scheduler: the PollScheduler of the site
+        :param rules: the RuleSet of the site, if not set windows are notified below the threshold
+        """
+        self.name = name
+        self.max_cube = max_cube
+        self.notifiers = notifiers
+        self.weather = weather
+        self.city = city
+        self.threshold = threshold
+        self.notifications = notifications
+        self.scheduler = scheduler
+        self.rules = rules
+        self.open_windows = {}
+        self._first_poll = True
+        self._last_temperature = None
+
+    def poll(self):
+        """
+        Polls the Max CUBE once and sends the due notifications
+        :return: True if a window is open or the temperature is below the threshold, so the site is polled faster
+        """
+        window_status = self.max_cube.window_switch_status()
+        if not window_status:
+            logging.log(logging.INFO, '{}: did not receive any data from MAX Cube'.format(self.name))
+            return bool(self.open_windows)
+
+        track_window_changes(self.max_cube, window_status, self.open_windows, self.notifications)
+        if self._first_poll:
+            self.notifications.retain(self.open_windows)
+            self._first_poll = False
+
+        # also needed while all windows are closed to decide on the poll interval, the FleetSupervisor keeps the
+        # shared cache filled for the cities of all sites
+        outside_temperature = self.weather.get_current_temperature(self.city) if self.weather else None
+        if outside_temperature is not None:
+            self._last_temperature = outside_temperature
+
+        if self.rules:
+            self.rules.reload_if_changed()
+        if self.rules or (outside_temperature is not None and outside_temperature <= self.threshold):
+            for rf_addr, open_duration in self.notifications.due(
+                    eligible=rules_filter(self.rules, self.open_windows, outside_temperature)):
+                message = '{}: {}'.format(self.name, notification_text(self.open_windows[rf_addr], open_duration,
+                                                                        self.city, outside_temperature))
+                for notifier in self.notifiers:
+                    try:
+                        notifier.send_msg(message)
+                    except Exception as e:
+                        logging.log(logging.ERROR, '{}: notifier failed to send a message: {}'.format(self.name, e))
+        self.notifications.save()
+
+        return bool(self.open_windows) or (self._last_temperature is not None and
+                                           self._last_temperature <= self.threshold)
+
+
+class FleetSupervisor:
+    def __init__(self, sites, max_concurrency=16):
+        """
+        Polls many Max CUBEs from one process. The sites are kept in a heap ordered by their next poll time, and
+        max_concurrency worker threads take the due sites from it, so no more than max_concurrency Max CUBEs are
+        polled at the same time. The first polls are spread evenly over the poll interval. The outside temperatures
+        of all site cities are refreshed together with get_current_temperatures before they expire, so numeric
+        city IDs are looked up in batches and the sites only read the shared cache
+        :param sites: list of FleetSite objects
+        :param max_concurrency: maximum number of Max CUBEs polled at the same time
+        """
+        self.sites = sites
+        self.max_concurrency = max_concurrency
+        self.polls = 0
+        self.failures = 0
+        self._schedule = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._workers = []
+
+        for i, site in enumerate(sites):
+            deadline = site.scheduler.shift(site.scheduler.interval * i / len(sites))
+            # the index keeps sites with the same deadline from being compared
+            heapq.heappush(self._schedule, (deadline, i, site))
+
+    def start(self):
+        targets = [self._poll_due_sites] * min(self.max_concurrency, len(self.sites))
+        if any(site.weather for site in self.sites):
+            targets.append(self._refresh_temperatures)
+        for target in targets:
+            worker = threading.Thread(target=target)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def run(self):
+        """
+        Supervises the sites until interrupted
+        """
+        self.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            self.stop()
+
+    def _next_due_site(self):
+        with self._condition:
+            while not self._stopped:
+                wait = self._schedule[0][0] - _monotonic() if self._schedule else 1
+                if wait <= 0:
+                    return heapq.heappop(self._schedule)
+                # waking up once a second keeps the workers responsive to stop()
+                self._condition.wait(min(wait, 1))
+        return None
+
+    def _refresh_temperatures(self):
+        cities = OrderedDict()
+        for site in self.sites:
+            if site.weather:
+                cities.setdefault(site.weather, set()).add(site.city)
+        period = min(weather.cache_ttl for weather in cities) * 0.9
+
+        while True:
+            for weather, weather_cities in cities.items():
+                try:
+                    # refreshes the temperatures older than half the cache ttl, so none of them expires before the
+                    # next refresh
+                    weather.get_current_temperatures(sorted(weather_cities), max_age=weather.cache_ttl / 2.0)
+                except Exception as e:
+                    logging.log(logging.ERROR, 'refreshing the outside temperatures failed: {}'.format(e))
+
+            refreshed = _monotonic()
+            with self._condition:
+                while not self._stopped and _monotonic() - refreshed < period:
+                    self._condition.wait(period - (_monotonic() - refreshed))
+                if self._stopped:
+                    return
+
+    def _poll_due_sites(self):
+        while True:
+            due = self._next_due_site()
+            if not due:
+                return
+            deadline, i, site = due
+
+            try:
+                active = site.poll()
+            except Exception as e:
+                self.failures += 1
+                logging.log(logging.ERROR, '{}: poll failed: {}'.format(site.name, e))
+                active = False
+            self.polls += 1
+
+            with self._condition:
+                heapq.heappush(self._schedule, (_monotonic() + site.scheduler.next_delay(active), i, site))
+                self._condition.notify()
+
+
+def create_fleet_sites(config, defaults, session, state_dir=None, debug=False):
+    """
+    Creates the sites of a fleet config. The config is a JSON object with a list of sites, each with the address of
+    its Max CUBE and optional settings overriding the fleet wide 'defaults', which in turn override the commandline
+    options:
+
+    {"owmappid": "...", "max_concurrency": 32,
+     "defaults": {"city": "munich,DE", "threshold": 12, "notifier": ["pushover"], "interval": 30},
+     "sites": [{"name": "flat-1", "cube_ip": "10.0.1.20", "user": "...", "token": "..."},
+               {"name": "flat-2", "cube_ip": "10.0.2.20", "city": "berlin,DE", "persistent": true}]}
+
+    The settings are cube_port, persistent, city, threshold, notifier, user, token, interval, fast_interval,
+    max_interval, notify_after, renotify, max_notifications, rules and deadline (an object of seconds by stage, of
+    which fetch and decode apply), using the units of the commandline options
+    :param config: the fleet config
+    :param defaults: dict of the settings taken from the commandline
+    :param session: the Session shared by all HTTP requests
+    :param state_dir: directory the notification tables of the sites are kept in, one file per site
+    :param debug: sends HTTPLIB debug output of the notifiers to stdout if set to 'True'
+    :return: list of FleetSite objects
+    :raises ValueError: if there is no Open Weather Map APPID or a site has no cube_ip
+    """
+    owmappid = config.get('owmappid') or defaults.get('owmappid')
+    if not owmappid:
+        raise ValueError('no Open Weather Map APPID in the fleet config or on the commandline')
+    weather = OpenWeatherMap(owmappid, cache_ttl=defaults['weather_ttl'] * 60,
+                             max_staleness=defaults['weather_max_age'] * 60, session=session)
+
+    sites = []
+    for site_config in config.get('sites', []):
+        settings = dict(defaults)
+        settings.update(config.get('defaults', {}))
+        settings.update(site_config)
+        if not settings.get('cube_ip'):
+            raise ValueError('site {} has no cube_ip'.format(site_config))
+        name = settings.get('name') or settings['cube_ip']
+        if not settings.get('notifier'):
+            settings['notifier'] = ['pushover']
+        elif isinstance(settings['notifier'], basestring):
+            settings['notifier'] = [settings['notifier']]
+        if settings.get('notify_after') is None:
+            settings['notify_after'] = float(settings['interval'])
+        if settings.get('max_interval') is None:
+            settings['max_interval'] = 2 * float(settings['interval'])
+
+        deadlines = dict(STAGE_DEADLINES)
+        deadlines.update(settings.get('deadline') or {})
+
+        max_cube = MaxConnection(cube_ip=settings['cube_ip'], cube_port=settings.get('cube_port', 62910),
+                                 persistent=settings.get('persistent', False), rediscover_after=0,
+                                 fetch_timeout=deadlines['fetch'], decode_timeout=deadlines['decode'])
+        notifiers = [get_notifier(notifier)(user=settings.get('user'), token=settings.get('token'), debug=debug,
+                                            session=session)
+                     for notifier in settings['notifier']]
+        rules = None
+        if settings.get('rules'):
+            rules = load_rules(settings['rules'], settings['notify_after'], settings['threshold'])
+        # with rules the time a window has to be open is part of the rules
+        notifications = NotificationState(notify_after=0 if rules else settings['notify_after'] * 60,
+                                          renotify_every=settings['renotify'] * 60,
+                                          max_notifications=settings['max_notifications'],
+                                          state_file=os.path.join(state_dir, 'sites', '{}.json'.format(name))
+                                          if state_dir else None)
+        scheduler = PollScheduler(float(settings['interval']) * 60, settings['fast_interval'] * 60,
+                                  settings['max_interval'] * 60)
+        sites.append(FleetSite(name, max_cube, notifiers, weather, settings['city'], settings['threshold'],
+                               notifications, scheduler, rules))
+
+    return sites
+
+
+def track_window_changes(max_cube, window_status, open_windows, notifications, now=None):
+    """
+    Applies the window status changes of the last poll to the open windows and the notification table
+    :param max_cube: the MaxConnection or MaxCubeGroup that was polled
+    :param window_status: the window status returned by the poll
+    :param open_windows: dict of the last known status of the open windows by key, updated in place. Windows of a
+    Max CUBE that was not reached on this poll keep their status, so the notifications can still name them
+    :param notifications: the NotificationState
+    :param now: the time of the poll, defaults to now
+    """
+    for rf_addr, old_status, new_status in max_cube.window_status_changes():
+        if new_status == 'open':
+            notifications.window_opened(rf_addr, now)
+        else:
+            open_windows.pop(rf_addr, None)
+            notifications.window_closed(rf_addr)
+    for rf_addr, window in window_status.items():
+        if window['status'] == 'open':
+            open_windows[rf_addr] = window
+
+
+def build_snapshot(max_cube, window_status, notifications, outside_temperature):
+    """
+    Builds the snapshot served by --snapshot-port from the state of the last poll
+    :param max_cube: the MaxConnection or MaxCubeGroup that was polled
+    :param window_status: the window status returned by the poll
+    :param notifications: the NotificationState, for the time each open window was opened
+    :param outside_temperature: the last known outside temperature, or None
+    :return: a JSON serializable dict with the windows, the devices and the outside temperature
+    """
+    windows = []
+    for key, window in sorted(window_status.items()):
+        window = dict(window, open_since=notifications.opened(key))
+        windows.append(window)
+    return {'windows': windows, 'devices': max_cube.device_status(), 'outside_temperature': outside_temperature}
+
+
+def open_window_message(window, open_duration):
+    """
+    :param window: the window as returned by window_switch_status
+    :param open_duration: time in seconds the window is open
+    :return: the notification text for an open window, mentioning a radiator valve open in the same room
+    """
+    message = '{} was open for more than {} minutes'.format(window['name'], int(open_duration // 60))
+    if window.get('heating'):
+        message += ' while the heating in the room was on'
+    return message
+
+
+def notification_text(window, open_duration, city, outside_temperature):
+    """
+    :return: the notification text for an open window including the outside temperature, if it is known
+    """
+    if outside_temperature is None:
+        return open_window_message(window, open_duration)
+    return '{}, and the temperature in {} is {}'.format(open_window_message(window, open_duration), city,
+                                                         outside_temperature)
+
+
+def load_rules(rules_file, notify_after, threshold):
+    """
+    Compiles a rules file, windows no rule decides on are notified like without rules file
+    :param rules_file: path to the rules file, see RuleSet for the format
+    :param notify_after: minutes a window has to be open before it is notified when no rule matches
+    :param threshold: the outside temperature threshold when no rule matches
+    :return: the RuleSet
+    :raises ValueError: if the rules file can't be read or contains an invalid rule
+    """
+    return RuleSet(rules_file, {'min_open_minutes': notify_after, 'max_outside_temperature': threshold})
+
+
+def rules_filter(rules, open_windows, outside_temperature, now=None):
+    """
+    :param open_windows: dict of the last known status of the open windows by key, see track_window_changes
+    :return: the function deciding with the rules which due windows are notified, to be passed to
+    NotificationState.due, or None without rules
+    """
+    if not rules:
+        return None
+    return lambda key, open_seconds: rules.allows(key, open_windows[key], open_seconds, outside_temperature, now)
+
+
+def replay_capture(capture_file, notifications, notify=None, rules=None, outside_temperature=None):
+    """
+    Feeds a capture file written by --record through the window status decoding and the notification logic as fast
+    as possible, the time of each record is used as the current time. The outside temperature is not looked up,
+    every due notification is counted
+    :param capture_file: path to the capture file
+    :param notifications: the NotificationState, without a state file
+    :param notify: the NotifierGroup the notifications are sent with, if not set they are only logged
+    :param rules: the RuleSet deciding which windows are notified
+    :param outside_temperature: the outside temperature the rules are evaluated with
+    """
+    # the replayed data is passed in directly, the Max CUBE address is never connected to
+    max_cube = MaxConnection(cube_ip='0.0.0.0', rediscover_after=0)
+    open_windows = {}
+    records = 0
+    received_bytes = 0
+    notification_count = 0
+    start = time.time()
+
+    for timestamp, cube_data in read_capture(capture_file):
+        records += 1
+        received_bytes += len(cube_data)
+        window_status = max_cube.window_switch_status(cube_data=cube_data)
+        if not window_status:
+            continue
+
+        track_window_changes(max_cube, window_status, open_windows, notifications, timestamp)
+        eligible = rules_filter(rules, open_windows, outside_temperature, timestamp)
+        for rf_addr, open_duration in notifications.due(timestamp, eligible):
+            notification_count += 1
+            message = open_window_message(open_windows[rf_addr], open_duration)
+            logging.log(logging.INFO, '{}: {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                                                      message))
+            if notify:
+                notify.send_msg(message)
+
+    duration = time.time() - start
+    if notify:
+        notify.flush()
+    print 'replayed {} records ({} bytes) in {:.3f}s, {:.0f} records/s, {} notifications'.format(
+        records, received_bytes, duration, records / duration if duration else 0, notification_count)
+
+
+def run_fleet(fleet_file, defaults, state_dir, max_concurrency, metrics_port=None, metrics_address='', debug=False):
+    """
+    Supervises all Max CUBEs of a fleet config file until interrupted, see create_fleet_sites for the format
+    """
+    try:
+        with open(fleet_file) as f:
+            config = json.load(f)
+    except (IOError, ValueError) as e:
+        sys.exit('could not read fleet config {}: {}'.format(fleet_file, e))
+    max_concurrency = config.get('max_concurrency', max_concurrency)
+
+    if metrics_port:
+        metrics.start_http_server(metrics_port, metrics_address)
+
+    # the workers share one keep-alive connection pool, sized so they don't have to wait for a connection
+    session = Session(debug=debug, verify=True, retries=2, pool_maxsize=max_concurrency)
+    try:
+        sites = create_fleet_sites(config, defaults, session, state_dir, debug)
+    except ValueError as e:
+        sys.exit('invalid fleet config {}: {}'.format(fleet_file, e))
+
+    logging.log(logging.INFO, 'supervising {} MAX Cubes, polling up to {} at the same time'.format(
+        len(sites), max_concurrency))
+    FleetSupervisor(sites, max_concurrency).run()
+
+
+def collect_metrics(max_cube, notify):
+    """
+    Metrics of values the MAX Cube connection and the notifiers count anyway, read on each scrape
+    :param max_cube: the MaxConnection or MaxCubeGroup
+    :param notify: the NotifierGroup
+    :return: list of (name, type, documentation, label names, samples) tuples
+    """
+    notifier_stats = notify.stats()
+    families = [('maxwindownotify_topology_cache_total', 'counter',
+                 'M: line decodes skipped (hit) or done (miss) by the topology cache', ('result',),
+                 [(('hit',), max_cube.topology_cache_hits), (('miss',), max_cube.topology_cache_misses)])]
+    for key, name, metric_type, documentation in [
+            ('sent', 'maxwindownotify_notifier_sent_total', 'counter', 'Notifications sent'),
+            ('failures', 'maxwindownotify_notifier_failures_total', 'counter', 'Notifications that failed to send'),
+            ('dropped', 'maxwindownotify_notifier_dropped_total', 'counter',
+             'Notifications dropped after waiting longer than --notifier-timeout')]:
+        families.append((name, metric_type, documentation, ('notifier',),
+                         [((notifier,), stats[key]) for notifier, stats in sorted(notifier_stats.items())]))
+    return families
+
+
+def stage_deadline(value):
+    """
+    Parses a --deadline argument
+    :param value: the argument as STAGE=SECONDS
+    :return: tuple of the stage name and the deadline in seconds
+    :raises argparse.ArgumentTypeError: if the stage is unknown or the deadline is not a positive number
+    """
+    stage, _, seconds = value.partition('=')
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        seconds = None
+    if stage not in STAGE_DEADLINES or not seconds > 0:
+        raise argparse.ArgumentTypeError('expected STAGE=SECONDS with STAGE one of {}, got {}'.format(
+            ', '.join(STAGE_DEADLINES), value))
+    return stage, seconds
+
 
 def main():
     parser = argparse.ArgumentParser(description="This deamon polls the MAX Cube for all window status. "
-                                                 "If a window is open longer than twice the poll interval a "
-                                                 "notification will be sent using the notifier plugin",
+                                                 "If a window is open longer than --notify-after minutes while the "
+                                                 "outside temperature is below the threshold, or as decided by "
+                                                 "--rules, a notification will be sent using the notifier plugins "
+                                                 "and repeated every --renotify minutes while the window stays open",
                                      epilog="As an alternative to the commandline, params can be placed in a file, "
                                             "one per line, and specified on the commandline like "
                                             "'%(prog)s @params.conf'.",
@@ -346,10 +1992,20 @@ def main():
                         "--interval",
                         help="polling interval in minutes (default 30 minutes)",
                         default=30)
+    parser.add_argument("--fast-interval",
+                        help="polling interval in minutes while a window is open or the temperature is below the "
+                             "threshold (default 5 minutes)",
+                        type=float,
+                        default=5)
+    parser.add_argument("--max-interval",
+                        help="longest polling interval in minutes the polling backs off to while all windows are "
+                             "closed and it is warm outside (default twice the polling interval)",
+                        type=float)
     parser.add_argument("-n",
                         "--network",
-                        help="Network Address to send search broadcast for MAX Cube (default 192.168.178.0/24)",
-                        default='192.168.178.0/24')
+                        help="Network Address to send search broadcast for MAX Cube (default 192.168.178.0/24), "
+                             "can be given several times or as comma separated list to search multiple networks",
+                        action="append")
     parser.add_argument("-c",
                         "--city",
                         help="the city name or code in OpenWeatherMap to retrieve the outside temperature from "
@@ -360,79 +2016,318 @@ def main():
                         help="the temperature threshold for suppressing notifications (default: 12C)",
                         type=float,
                         default=12)
+    parser.add_argument("--weather-ttl",
+                        help="minutes a retrieved outside temperature is used before it is refreshed (default 10)",
+                        type=float,
+                        default=10)
+    parser.add_argument("--weather-max-age",
+                        help="minutes an outdated outside temperature is still used while it is refreshed or when "
+                             "Open Weather Map can't be reached (default 60)",
+                        type=float,
+                        default=60)
     parser.add_argument("-k",
                         "--owmappid",
-                        help="the API Key (APPID) to authenticate with Open Weather Map",
-                        required=True)
+                        help="the API Key (APPID) to authenticate with Open Weather Map, required unless --replay "
+                             "is used")
     parser.add_argument("-s",
                         "--simulation",
                         help="randomly simulate open windows",
                         action="store_true")
+    parser.add_argument("--notifier",
+                        help="notifier module to send the notifications with, can be given several times to notify "
+                             "through all of them (available: {}, default pushover)".format(
+                            ', '.join(available_notifiers())),
+                        choices=available_notifiers(),
+                        action="append")
+    parser.add_argument("--notifier-timeout",
+                        help="seconds a notification may wait for a notifier before it is dropped (default 60)",
+                        type=float,
+                        default=60)
     parser.add_argument("-u",
                         "--user",
                         help="the username (or user key) used for the notifier module")
     parser.add_argument("-p",
                         "--token",
                         help="the password (or app token) used for the notifier module")
+    parser.add_argument("--notify-after",
+                        help="minutes a window has to be open before the first notification (default: the polling "
+                             "interval)",
+                        type=float)
+    parser.add_argument("--renotify",
+                        help="minutes between further notifications while a window stays open, 0 notifies only once "
+                             "(default 60)",
+                        type=float,
+                        default=60)
+    parser.add_argument("--max-notifications",
+                        help="maximum number of notifications per hour over all windows (default 20)",
+                        type=int,
+                        default=20)
+    parser.add_argument("--rules",
+                        help="JSON file with per room and per device notification rules, changes are picked up "
+                             "without restart. Windows no rule decides on are notified after --notify-after below "
+                             "--threshold",
+                        metavar="FILE")
+    parser.add_argument("--all-cubes",
+                        help="poll all MAX Cubes answering the discover broadcast instead of only the first one",
+                        action="store_true")
+    parser.add_argument("--persistent",
+                        help="keep the connection to the MAX Cube open and only refresh the window status on "
+                             "each poll",
+                        action="store_true")
+    parser.add_argument("--state-dir",
+                        help="directory to keep the daemon state like the last discovered MAX Cube in "
+                             "(default ~/.maxwindownotify)",
+                        default=os.path.join(os.path.expanduser('~'), '.maxwindownotify'))
+    parser.add_argument("--rediscover",
+                        help="ignore the MAX Cube remembered from the last start and run the full discovery",
+                        action="store_true")
+    parser.add_argument("--rediscover-after",
+                        help="rerun the MAX Cube discovery in the background after this many failed polls in a row "
+                             "(default 3, 0 disables it)",
+                        type=int,
+                        default=3)
+    parser.add_argument("--cycle-budget",
+                        help="seconds a poll cycle may take before the watchdog aborts it and continues with the "
+                             "next cycle, 0 disables the watchdog (default 120)",
+                        type=float,
+                        default=120)
+    parser.add_argument("--deadline",
+                        help="deadline of a stage of the poll cycle, can be given several times. A stage running "
+                             "longer is cut short and the last good data is used. The stages are discover "
+                             "(default 60), fetch (default 20), decode (default 5, only counted), weather "
+                             "(default 15) and notify (default: --notifier-timeout)",
+                        type=stage_deadline,
+                        action="append",
+                        default=[],
+                        metavar="STAGE=SECONDS")
+    parser.add_argument("--fleet",
+                        help="supervise all MAX Cubes listed in this JSON config file from one process, the other "
+                             "options are the defaults of the sites",
+                        metavar="CONFIG")
+    parser.add_argument("--max-concurrency",
+                        help="maximum number of MAX Cubes polled at the same time in fleet mode, can also be set "
+                             "in the config file (default 16)",
+                        type=int,
+                        default=16)
+    parser.add_argument("--record",
+                        help="append the raw MAX Cube data of every poll to a capture file in this directory",
+                        metavar="DIR")
+    parser.add_argument("--replay",
+                        help="feed a capture file written by --record through the window status and notification "
+                             "logic as fast as possible and exit, notifications are only sent if --notifier is "
+                             "given",
+                        metavar="FILE")
+    parser.add_argument("--metrics-port",
+                        help="serve Prometheus metrics on http://<metrics-address>:<port>/metrics (default: disabled)",
+                        type=int)
+    parser.add_argument("--metrics-address",
+                        help="address the metrics endpoint listens on (default: all addresses)",
+                        default='')
+    parser.add_argument("--snapshot-port",
+                        help="serve the latest window and device status as JSON on "
+                             "http://<snapshot-address>:<port>/snapshot (default: disabled)",
+                        type=int)
+    parser.add_argument("--snapshot-address",
+                        help="address the snapshot endpoint listens on (default 127.0.0.1)",
+                        default='127.0.0.1')
     parser.add_argument("-v",
                         "--verbose",
                         help="increase output verbosity",
                         action="store_true")
     args = parser.parse_args()
+    if not args.owmappid and not args.replay and not args.fleet:
+        parser.error('argument -k/--owmappid is required')
+    if args.fleet and (args.replay or args.record or args.all_cubes):
+        parser.error('argument --fleet can not be used together with --replay, --record or --all-cubes')
+    if args.snapshot_port and (args.fleet or args.replay):
+        parser.error('argument --snapshot-port can not be used together with --fleet or --replay')
+    # in fleet mode the intervals are resolved per site
+    fleet_defaults = dict(vars(args))
+    if args.record and args.all_cubes:
+        parser.error('argument --record can only be used with a single MAX Cube')
+    if not args.network:
+        args.network = ['192.168.178.0/24']
+    replay_notifiers = bool(args.notifier)
+    if not args.notifier:
+        args.notifier = ['pushover']
+    if args.notify_after is None:
+        args.notify_after = float(args.interval)
+    if args.max_interval is None:
+        args.max_interval = 2 * float(args.interval)
 
     if args.verbose:
         loglevel = logging.DEBUG
     else:
         loglevel = logging.WARNING
 
-    last_window_status = None
+    open_windows = {}
+    first_poll = True
     logging.basicConfig(format="%(asctime)-15s %(levelname)s: %(message)s", level=loglevel)
     notifier_log_http = False
     if loglevel == logging.DEBUG:
         notifier_log_http = True
-    if args.user and args.token:
-        notify = Notifier(user=args.user, token=args.token, debug=notifier_log_http)
-    else:
-        notify = Notifier()
-
-    temperature = OpenWeatherMap(args.owmappid)
+    if args.fleet:
+        run_fleet(args.fleet, fleet_defaults, args.state_dir, args.max_concurrency, args.metrics_port,
+                  args.metrics_address, notifier_log_http)
+        return
+
+    deadlines = dict(args.deadline)
+    deadlines.setdefault('notify', args.notifier_timeout)
+    budget = CycleBudget(args.cycle_budget, deadlines)
+
+    # one keep-alive connection pool for all outbound HTTP requests
+    session = Session(debug=notifier_log_http, verify=True, retries=2)
+    notify = None
+    if not args.replay or replay_notifiers:
+        notify = NotifierGroup(dict((name, get_notifier(name)(user=args.user, token=args.token,
+                                                              debug=notifier_log_http, session=session))
+                                    for name in args.notifier), timeout=budget.deadlines['notify'],
+                               send_seconds=_NOTIFIER_SEND_SECONDS)
+
+    rules = None
+    if args.rules:
+        try:
+            rules = load_rules(args.rules, args.notify_after, args.threshold)
+        except ValueError as e:
+            sys.exit(str(e))
+    # with rules the time a window has to be open is part of the rules
+    notify_after = 0 if rules else args.notify_after * 60
+
+    if args.replay:
+        notifications = NotificationState(notify_after=notify_after, renotify_every=args.renotify * 60,
+                                          max_notifications=args.max_notifications)
+        try:
+            # without weather data the rules see the threshold as outside temperature
+            replay_capture(args.replay, notifications, notify, rules, args.threshold)
+        except (IOError, ValueError) as e:
+            sys.exit('could not replay {}: {}'.format(args.replay, e))
+        return
+
+    temperature = OpenWeatherMap(args.owmappid, cache_ttl=args.weather_ttl * 60,
+                                 max_staleness=args.weather_max_age * 60, session=session)
+
+    # started before the discovery so it is measured as well
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port, args.metrics_address)
+    snapshots = None
+    if args.snapshot_port:
+        snapshots = SnapshotStore()
+        snapshot.start_http_server(snapshots, args.snapshot_port, args.snapshot_address)
 
     logging.log(logging.INFO, 'searching for MAX Cube in the network')
-    max_cube = MaxConnection(discover_ip_subnet=args.network)
+    if args.all_cubes:
+        max_cube = MaxCubeGroup(discover_ip_subnet=args.network, persistent=args.persistent,
+                                discover_timeout=budget.deadlines['discover'],
+                                fetch_timeout=budget.deadlines['fetch'], decode_timeout=budget.deadlines['decode'])
+    else:
+        max_cube = MaxConnection(discover_ip_subnet=args.network, persistent=args.persistent,
+                                 discovery_cache=os.path.join(args.state_dir, 'cube.json'),
+                                 rediscover=args.rediscover, rediscover_after=args.rediscover_after,
+                                 recorder=CaptureWriter(args.record) if args.record else None,
+                                 discover_timeout=budget.deadlines['discover'],
+                                 fetch_timeout=budget.deadlines['fetch'], decode_timeout=budget.deadlines['decode'])
+
+    scheduler = PollScheduler(float(args.interval) * 60, args.fast_interval * 60, args.max_interval * 60)
+    last_temperature = None
+    notifications = NotificationState(notify_after=notify_after, renotify_every=args.renotify * 60,
+                                      max_notifications=args.max_notifications,
+                                      state_file=os.path.join(args.state_dir, 'notifications.json'))
+
+    if args.metrics_port:
+        metrics.register_collector(lambda: collect_metrics(max_cube, notify))
 
     while True:
         skip_run = False
-        window_status = max_cube.window_switch_status(args.simulation)
-        logging.log(logging.INFO, 'current window data: {}'.format(window_status))
-        outside_temperature = temperature.get_current_temperature(args.city)
-        logging.log(logging.INFO, 'current temperature in {}: {}'.format(args.city, outside_temperature))
-
-        if not window_status:
-            skip_run = True
-            logging.log(logging.INFO, 'did not receive any data from MAX Cube, skipping this cycle')
-        elif not outside_temperature:
-            skip_run = True
-            logging.log(logging.INFO, 'did not receive any temperature data, skipping this cycle')
-        elif not outside_temperature <= args.threshold:
-            skip_run = True
-            logging.log(logging.INFO, 'current outside temperature above threshold of {}, skipping this '
-                                      'cycle'.format(args.threshold))
-
-        if not last_window_status and window_status:
-            last_window_status = window_status
-
-        if not skip_run:
-            for rf_addr in window_status:
-                if window_status[rf_addr]['status'] == 'open':
-                    if window_status[rf_addr]['status'] == last_window_status[rf_addr]['status']:
-                        logging.log(logging.INFO, 'sending notify because of open window')
-                        notify.send_msg('{} was open for more than {} minutes, and the temperature '
-                                        'in {} is {}'.format(window_status[rf_addr]['name'],
-                                                             args.interval, args.city, outside_temperature))
-        last_window_status = window_status
-        logging.log(logging.INFO, 'sleeping for {} minutes'.format(args.interval))
-        time.sleep(int(args.interval)*60)
-
+        cycle_start = time.time()
+        try:
+            budget.arm()
+            if rules:
+                rules.reload_if_changed()
+
+            # if a window was open on the last poll the weather is fetched in parallel to the MAX Cube poll,
+            # otherwise after it
+            weather_call = None
+            weather_parallel = bool(open_windows)
+            if weather_parallel:
+                weather_call = BackgroundCall(temperature.get_current_temperature, args.city)
+
+            window_status = max_cube.window_switch_status(args.simulation)
+            cube_duration = time.time() - cycle_start
+            logging.log(logging.INFO, 'current window data: {}'.format(window_status))
+            logging.log(logging.DEBUG, 'MAX Cube topology cache hits: {}, misses: {}'.format(
+                max_cube.topology_cache_hits, max_cube.topology_cache_misses))
+
+            if window_status:
+                track_window_changes(max_cube, window_status, open_windows, notifications)
+                if first_poll:
+                    notifications.retain(open_windows)
+                    first_poll = False
+
+            if not weather_call:
+                # the poll interval depends on the outside temperature also while all windows are closed, the cache
+                # keeps this to one request per --weather-ttl
+                weather_call = BackgroundCall(temperature.get_current_temperature, args.city)
+            if budget.wait('weather', weather_call):
+                outside_temperature, weather_duration = weather_call.result, weather_call.duration
+            else:
+                # the lookup keeps running in the background, its result fills the cache for the next cycle
+                outside_temperature = last_temperature
+                weather_duration = time.time() - weather_call.started
+            logging.log(logging.INFO, 'current temperature in {}: {}'.format(args.city, outside_temperature))
+            if outside_temperature is not None:
+                last_temperature = outside_temperature
+            if snapshots and window_status:
+                snapshots.publish(build_snapshot(max_cube, window_status, notifications, last_temperature))
+
+            if not window_status:
+                skip_run = True
+                logging.log(logging.INFO, 'did not receive any data from MAX Cube, skipping this cycle')
+            elif not open_windows:
+                skip_run = True
+                logging.log(logging.INFO, 'no window is open, skipping this cycle')
+            elif rules:
+                # the rules decide per window, also without temperature data
+                pass
+            elif outside_temperature is None:
+                skip_run = True
+                logging.log(logging.INFO, 'did not receive any temperature data, skipping this cycle')
+            elif not outside_temperature <= args.threshold:
+                skip_run = True
+                logging.log(logging.INFO, 'current outside temperature above threshold of {}, skipping this '
+                                          'cycle'.format(args.threshold))
+
+            if weather_parallel:
+                weather_stage = '{:.3f}s (in parallel)'.format(weather_duration)
+            else:
+                weather_stage = '{:.3f}s (after the MAX Cube poll)'.format(weather_duration)
+            logging.log(logging.INFO, 'cycle took {:.3f}s, MAX Cube poll {:.3f}s, weather lookup {}'.format(
+                time.time() - cycle_start, cube_duration, weather_stage))
+            _CYCLE_SECONDS.observe(time.time() - cycle_start)
+            _OPEN_WINDOWS.set(len(open_windows))
+
+            if not skip_run:
+                messages = []
+                for rf_addr, open_duration in notifications.due(
+                        eligible=rules_filter(rules, open_windows, outside_temperature)):
+                    logging.log(logging.INFO, 'sending notify because of open window')
+                    messages.append(notification_text(open_windows[rf_addr], open_duration, args.city,
+                                                      outside_temperature))
+                # sent as one batch, so the notifiers can join the notifications of the cycle
+                if messages:
+                    notify.send_batch(messages)
+        except CycleTimeout as e:
+            budget.restarted()
+            logging.log(logging.ERROR, '{}, restarting the poll loop'.format(e))
+            # the connection may be left in the middle of a transfer, the next poll reconnects
+            max_cube.close()
+        finally:
+            budget.disarm()
+        notifications.save()
+
+        active = bool(open_windows) or (last_temperature is not None and last_temperature <= args.threshold)
+        delay = scheduler.next_delay(active)
+        logging.log(logging.INFO, 'sleeping for {:.1f} minutes'.format(delay / 60))
+        time.sleep(delay)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import logging
+import threading
+import BaseHTTPServer
+import SocketServer
+
+# default histogram buckets in seconds, from a fast local MAX Cube poll up to a hanging HTTP request
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(labelnames, labelvalues):
+    if not labelnames:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                          for name, value in zip(labelnames, labelvalues)) + '}'
+
+
+class _Metric:
+    metric_type = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self._registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        # metrics without labels are exposed right away, not only after their first update
+        if not self.labelnames:
+            self._values[()] = self._initial_value()
+
+    def _initial_value(self):
+        return 0
+
+    def samples(self):
+        """
+        :return: list of (name suffix, label names, label values, value) tuples of the current values
+        """
+        with self._lock:
+            return [('', self.labelnames, labels, value) for labels, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        """
+        Increases the counter, does nothing while the metrics are disabled
+        :param amount: the amount to add
+        :param labels: tuple of label values in the order of the label names
+        """
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, labels=()):
+        """
+        Sets the gauge, does nothing while the metrics are disabled
+        :param value: the current value
+        :param labels: tuple of label values in the order of the label names
+        """
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        _Metric.__init__(self, registry, name, documentation, labelnames)
+
+    def _initial_value(self):
+        # one count per bucket followed by the sum of all observations
+        return [0] * len(self.buckets) + [0.0]
+
+    def observe(self, value, labels=()):
+        """
+        Records an observation, does nothing while the metrics are disabled
+        :param value: the observed value, e.g. a duration in seconds
+        :param labels: tuple of label values in the order of the label names
+        """
+        if not self._registry.enabled:
+            return
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = self._initial_value()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        bucket_labelnames = self.labelnames + ('le',)
+        with self._lock:
+            for labels, counts in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', bucket_labelnames, labels + (_format_value(bound),), cumulative))
+                samples.append(('_sum', self.labelnames, labels, counts[-1]))
+                samples.append(('_count', self.labelnames, labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        """
+        Collection of the metrics exposed in the Prometheus text format. Until the registry is enabled all
+        updates of its metrics return right away, so the instrumentation costs close to nothing
+        """
+        self.enabled = False
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._add(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._add(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self, name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector):
+        """
+        Adds a function called on every scrape, for values that are already counted elsewhere
+        :param collector: callable returning a list of (name, type, documentation, label names, samples) tuples,
+        samples being a list of (label values, value) tuples
+        """
+        self._collectors.append(collector)
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        families = [(metric.name, metric.metric_type, metric.documentation, metric.samples())
+                    for metric in self._metrics]
+        for collector in self._collectors:
+            try:
+                for name, metric_type, documentation, labelnames, samples in collector():
+                    families.append((name, metric_type, documentation,
+                                     [('', labelnames, labels, value) for labels, value in samples]))
+            except Exception as e:
+                logging.log(logging.ERROR, 'metrics collector failed: {}'.format(e))
+
+        lines = []
+        for name, metric_type, documentation, samples in families:
+            lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for suffix, labelnames, labels, value in samples:
+                lines.append('{}{}{} {}'.format(name, suffix, _format_labels(labelnames, labels),
+                                                _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+register_collector = REGISTRY.register_collector
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.log(logging.DEBUG, 'metrics request from {}: {}'.format(self.client_address[0], format % args))
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, address='', registry=REGISTRY):
+    """
+    Enables the metrics of the registry and serves them on http://address:port/metrics from a background thread
+    :param port: TCP port to listen on
+    :param address: address to listen on, defaults to all addresses
+    :param registry: the registry to serve
+    :return: the HTTP server
+    """
+    class MetricsHandler(_MetricsHandler):
+        pass
+    MetricsHandler.registry = registry
+
+    server = _ThreadingHTTPServer((address, port), MetricsHandler)
+    registry.enabled = True
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.log(logging.INFO, 'serving metrics on port {}'.format(port))
+    return server
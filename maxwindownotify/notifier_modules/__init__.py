@@ -18,3 +18,135 @@
 # IN THE SOFTWARE.
 
 __author__ = 'yfauser'
+
+import os
+import time
+import pkgutil
+import logging
+import importlib
+import threading
+import Queue
+
+
+def available_notifiers():
+    """
+    Lists the notifier modules, a module named '<name>_notifier' in this package is available as '<name>'
+    :return: sorted list of the notifier names
+    """
+    return sorted(name[:-len('_notifier')] for loader, name, is_package
+                  in pkgutil.iter_modules([os.path.dirname(os.path.abspath(__file__))]) if name.endswith('_notifier'))
+
+
+def get_notifier(name):
+    """
+    Imports a notifier module on first use
+    :param name: the notifier name as returned by available_notifiers, e.g. 'pushover'
+    :return: the Notifier class of the module
+    :raises ValueError: if there is no notifier module with this name
+    """
+    if name not in available_notifiers():
+        raise ValueError('unknown notifier {}, available notifiers are: {}'.format(
+            name, ', '.join(available_notifiers())))
+
+    return importlib.import_module('{}.{}_notifier'.format(__name__, name)).Notifier
+
+
+class NotifierGroup:
+    def __init__(self, notifiers, timeout=60, send_seconds=None):
+        """
+        Sends each message to several notifiers concurrently, every notifier has its own worker thread and queue so
+        a slow notifier can't delay the others or the caller. Asynchronous notifiers are switched to send right
+        away, so flush() and the timeout cover the delivery and not only the hand over to a second queue. Messages
+        queued together with send_batch are handed to the send_batch method of notifiers that have one, so e.g.
+        the Pushover notifier still coalesces them into as few notifications as possible
+        :param notifiers: dict of Notifier objects by name
+        :param timeout: time in seconds a message may wait for a notifier, older messages are dropped for it
+        :param send_seconds: histogram with a 'notifier' label observing the time each send took
+        """
+        self.notifiers = notifiers
+        self.timeout = timeout
+        self.send_seconds_histogram = send_seconds
+        self.dropped = dict((name, 0) for name in notifiers)
+        self.sent = dict((name, 0) for name in notifiers)
+        self.failures = dict((name, 0) for name in notifiers)
+        self.send_seconds = dict((name, 0.0) for name in notifiers)
+        self._queues = {}
+        for name, notifier in notifiers.items():
+            if getattr(notifier, 'asynchronous', False):
+                notifier.asynchronous = False
+            self._queues[name] = Queue.Queue()
+            worker = threading.Thread(target=self._send_queued, args=(name, notifier, self._queues[name]))
+            worker.daemon = True
+            worker.start()
+
+    def send_msg(self, message):
+        """
+        queues the message for all notifiers
+        :param message: The notification (message) text
+        """
+        self.send_batch([message])
+
+    def send_batch(self, messages):
+        """
+        queues several messages, e.g. all notifications of a poll cycle, to be sent together by all notifiers
+        :param messages: list of notification (message) texts
+        """
+        for notifier_queue in self._queues.values():
+            notifier_queue.put((time.time(), messages))
+
+    def flush(self):
+        """
+        waits until all notifiers handled their queued messages
+        """
+        for notifier_queue in self._queues.values():
+            notifier_queue.join()
+
+    def stats(self):
+        """
+        Notifiers that keep their own delivery statistics, like the Pushover notifier counting deliveries that failed
+        after all retries, report them through a stats() method, for the others the calls of send_msg are counted
+        :return: dict by notifier name with the number of sent, failed and dropped messages and the total time in
+        seconds spent sending them
+        """
+        stats = {}
+        for name, notifier in self.notifiers.items():
+            if hasattr(notifier, 'stats'):
+                notifier_stats = notifier.stats()
+                notifier_stats['failures'] += self.failures[name]
+            else:
+                notifier_stats = {'sent': self.sent[name], 'failures': self.failures[name],
+                                  'send_seconds': self.send_seconds[name]}
+            notifier_stats['dropped'] = self.dropped[name]
+            stats[name] = notifier_stats
+        return stats
+
+    def _timed(self, name, send, argument):
+        start = time.time()
+        try:
+            send(argument)
+        finally:
+            duration = time.time() - start
+            self.send_seconds[name] += duration
+            if self.send_seconds_histogram:
+                self.send_seconds_histogram.observe(duration, labels=(name,))
+
+    def _send_queued(self, name, notifier, notifier_queue):
+        while True:
+            queued, messages = notifier_queue.get()
+            try:
+                if time.time() - queued > self.timeout:
+                    self.dropped[name] += len(messages)
+                    logging.log(logging.WARNING, 'notifier {} did not send {} message(s) within {}s, dropping '
+                                                 'them'.format(name, len(messages), self.timeout))
+                    continue
+                if hasattr(notifier, 'send_batch'):
+                    self._timed(name, notifier.send_batch, messages)
+                else:
+                    for message in messages:
+                        self._timed(name, notifier.send_msg, message)
+                self.sent[name] += len(messages)
+            except Exception as e:
+                self.failures[name] += 1
+                logging.log(logging.ERROR, 'notifier {} failed to send a message: {}'.format(name, e))
+            finally:
+                notifier_queue.task_done()
@@ -19,63 +19,152 @@
 
 __author__ = 'yfauser'
 
-import httplib
-import urllib
+import os
 import argparse
 import logging
 import sys
 import time
+import threading
+import Queue
+
+# Pushover rejects messages longer than this
+MAX_MESSAGE_LENGTH = 1024
 
 class Notifier:
-    def __init__(self, user=None, token=None, debug=False):
+    def __init__(self, user=None, token=None, debug=False, session=None, asynchronous=True, coalesce_delay=1.0,
+                 retries=3, backoff=2.0):
         """
         Notifier Object
         :param user: The user key as generated when registering to Pushover service
         :param token: The App Token as generated when creating the app in the Pushover service
         :param debug: If set to 'True', sends detailed HTTP Log to stdout
+        :param session: the shared maxwindownotify Session used for the requests, a new one is created if not set
+        :param asynchronous: if set to 'True', send_msg only queues the message and a background worker sends it
+        :param coalesce_delay: time in seconds the worker waits for further messages to send them as one notification
+        :param retries: number of retries of a notification after connection errors or server errors
+        :param backoff: the retries back off for backoff * (2 ^ (retry number - 1)) seconds
         """
         self._debug = debug
         self._user = user
         self._token = token
+        self.asynchronous = asynchronous
+        self._coalesce_delay = coalesce_delay
+        self._retries = retries
+        self._backoff = backoff
+        self._stats = {'sent': 0, 'failures': 0, 'send_seconds': 0.0}
+        self._queue = Queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
 
         if not self._user or not self._token:
             logging.log(logging.ERROR, 'This nofifier module needs a user key and app token to be set')
             sys.exit('exiting because of missing user key and app token in notifier')
 
-        # if debug then enable underlying httplib debugging
-        if self._debug:
-            httplib.HTTPConnection.debuglevel = 1
+        if not session:
+            from maxwindownotify.http_session import Session
+            session = Session(debug=debug, verify=True)
+        self._session = session
 
     def send_msg(self, message):
         """
-        sends a notification (message) to Pushover app
+        sends a notification (message) to Pushover app. In asynchronous mode the message is only queued, and
+        messages queued within coalesce_delay are sent together as one notification
         :param message: The notification (message) text
         :return: Tuple;
         [0] contains the HTTP return code like '200'
         [1] contains the return code reason, like 'OK' for a '200'
-        Returns None if an error occured
+        Returns None if an error occured, or always in asynchronous mode
+        """
+        if not self.asynchronous:
+            return self._deliver(str(message))
+
+        self._queue.put(str(message))
+        with self._worker_lock:
+            if not self._worker or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._send_queued)
+                self._worker.daemon = True
+                self._worker.start()
+        return None
+
+    def send_batch(self, messages):
+        """
+        sends several messages right away, joined into as few notifications as the Pushover message length allows
+        :param messages: list of notification (message) texts
+        :return: list with the result of each notification as returned by send_msg in synchronous mode
+        """
+        return [self._deliver(notification) for notification in self._coalesce([str(m) for m in messages])]
+
+    def flush(self):
+        """
+        waits until all queued messages were sent
+        """
+        self._queue.join()
+
+    def stats(self):
+        """
+        :return: dict with the number of delivered and undeliverable notifications and the total time in seconds
+        spent delivering them, retries included
         """
-        session = httplib.HTTPSConnection("api.pushover.net:443")
-        session.request("POST", "/1/messages.json", urllib.urlencode({"token": self._token,
-                                                                      "user": self._user,
-                                                                      "message": str(message)}),
-                        {"Content-type": "application/x-www-form-urlencoded"})
+        return dict(self._stats)
+
+    def _send_queued(self):
+        while True:
+            messages = [self._queue.get()]
+            deadline = time.time() + self._coalesce_delay
+            while True:
+                try:
+                    messages.append(self._queue.get(timeout=max(0.001, deadline - time.time())))
+                except Queue.Empty:
+                    break
+
+            self.send_batch(messages)
+            for message in messages:
+                self._queue.task_done()
+
+    @staticmethod
+    def _coalesce(messages):
+        """
+        joins messages into as few notifications as the Pushover message length allows
+        """
+        notifications = []
+        for message in messages:
+            message = message[:MAX_MESSAGE_LENGTH]
+            if notifications and len(notifications[-1]) + 1 + len(message) <= MAX_MESSAGE_LENGTH:
+                notifications[-1] += '\n' + message
+            else:
+                notifications.append(message)
+        return notifications
+
+    def _deliver(self, message):
+        start = time.time()
         try:
-            time.sleep(1)
-            response = session.getresponse()
-        except httplib.ResponseNotReady as e:
-            logging.log(logging.WARNING, 'HTTPLib issue when retrieving response from Pushover Service: {}'.format(e))
-            session.close()
-            return None
-
-        if response.status not in [200]:
-            logging.log(logging.ERROR, 'received bad status code for Pushover service, '
-                                       'response was: {}, {}'.format(response.status, response.reason))
-            return None
+            return self._deliver_with_retries(message)
+        finally:
+            self._stats['send_seconds'] += time.time() - start
+
+    def _deliver_with_retries(self, message):
+        for attempt in range(self._retries + 1):
+            if attempt:
+                time.sleep(self._backoff * 2 ** (attempt - 1))
 
-        session.close()
+            response = self._session.do_request('POST', 'https://api.pushover.net/1/messages.json',
+                                                data={'token': self._token, 'user': self._user, 'message': message})
 
-        return response.status, response.reason
+            if response['status'] in [200]:
+                self._stats['sent'] += 1
+                return response['status'], response['reason']
+
+            # connection errors, rate limiting and server errors are worth a retry
+            transient = response['status'] == 'connection exception' or response['status'] == 429 or \
+                response['status'] >= 500
+            logging.log(logging.ERROR, 'received bad status code for Pushover service, '
+                                       'response was: {}, {}'.format(response['status'],
+                                                                     response['reason'] or response['body']))
+            if not transient:
+                break
+
+        self._stats['failures'] += 1
+        return None
 
 
 def main(args, loglevel):
@@ -85,10 +174,13 @@ def main(args, loglevel):
     if loglevel == logging.DEBUG:
         http_debug = True
 
-    notify = Notifier(args.user_key, args.app_token, debug=http_debug)
+    notify = Notifier(args.user_key, args.app_token, debug=http_debug, asynchronous=False)
     notify.send_msg(args.message)
 
 if __name__ == '__main__':
+    # run as a script from a source checkout, make the maxwindownotify package importable for the http session
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
     parser = argparse.ArgumentParser(description="This notifier will send messages using the Pushover Andriod App",
                                      epilog="As an alternative to the commandline, params can be placed in a file, "
                                             "one per line, and specified on the commandline like "
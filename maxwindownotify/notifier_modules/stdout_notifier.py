@@ -21,7 +21,10 @@ __author__ = 'yfauser'
 
 
 class Notifier:
-    def __init__(self, debug=False):
+    def __init__(self, user=None, token=None, debug=False, session=None):
+        """
+        Notifier Object printing the notifications to stdout, user, token and session are not used
+        """
         self._debug = debug
 
     @staticmethod
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import os
+import json
+import time
+import logging
+
+# conditions a rule can have besides the selectors and the action, all are optional
+CONDITIONS = ('min_open_minutes', 'max_open_minutes', 'min_outside_temperature', 'max_outside_temperature',
+              'between', 'heating')
+SELECTORS = ('room', 'device')
+ACTIONS = ('notify', 'suppress')
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def _text(value):
+    """
+    :return: the value as lower case unicode for comparing names, byte strings like the room and device names of
+    the M: line are decoded as UTF-8
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace').lower()
+    return unicode(value).lower()
+
+
+def _minute_of_day(clock):
+    """
+    :param clock: time of day as 'HH:MM'
+    :return: the minutes since midnight
+    """
+    try:
+        hours, minutes = [int(part) for part in clock.split(':')]
+    except (AttributeError, ValueError):
+        raise ValueError('invalid time of day {}, expected HH:MM'.format(clock))
+    if not 0 <= hours < 24 or not 0 <= minutes < 60:
+        raise ValueError('invalid time of day {}, expected HH:MM'.format(clock))
+    return hours * 60 + minutes
+
+
+def compile_rule(rule):
+    """
+    Compiles a rule into a selector and a list of predicates, so evaluating it does not have to look at the
+    conditions the rule does not use
+    :param rule: dict with the optional selectors 'room' and 'device' (names, ids or rf addresses as hex, a single
+    value or a list), the optional conditions in CONDITIONS and the action 'notify' (default) or 'suppress'
+    :return: tuple of (selector, predicates, action). The selector is called with a window and returns True if the
+    rule applies to it, each predicate is called with (window, seconds open, outside temperature, minute of day)
+    :raises ValueError: if the rule is invalid
+    """
+    if not isinstance(rule, dict):
+        raise ValueError('rule {} is not an object'.format(rule))
+    unknown = set(rule) - set(CONDITIONS + SELECTORS + ('action', 'name'))
+    if unknown:
+        raise ValueError('unknown keys {} in rule {}'.format(', '.join(sorted(unknown)), rule))
+    action = rule.get('action', 'notify')
+    if action not in ACTIONS:
+        raise ValueError('unknown action {} in rule {}, expected one of {}'.format(action, rule, ', '.join(ACTIONS)))
+
+    rooms = set(_text(room) for room in _as_list(rule['room'])) if 'room' in rule else None
+    devices = set(_text(device) for device in _as_list(rule['device'])) if 'device' in rule else None
+
+    def selector(window):
+        if rooms is not None and _text(window.get('room')) not in rooms and \
+                unicode(window.get('room_id')) not in rooms:
+            return False
+        if devices is not None and _text(window['name']) not in devices and \
+                '{:06x}'.format(window['rf_address']) not in devices:
+            return False
+        return True
+
+    predicates = []
+    try:
+        if 'min_open_minutes' in rule:
+            min_open = float(rule['min_open_minutes']) * 60
+            predicates.append(lambda window, open_seconds, temperature, minute: open_seconds >= min_open)
+        if 'max_open_minutes' in rule:
+            max_open = float(rule['max_open_minutes']) * 60
+            predicates.append(lambda window, open_seconds, temperature, minute: open_seconds <= max_open)
+        if 'min_outside_temperature' in rule:
+            min_temperature = float(rule['min_outside_temperature'])
+            predicates.append(lambda window, open_seconds, temperature, minute:
+                              temperature is not None and temperature >= min_temperature)
+        if 'max_outside_temperature' in rule:
+            max_temperature = float(rule['max_outside_temperature'])
+            predicates.append(lambda window, open_seconds, temperature, minute:
+                              temperature is not None and temperature <= max_temperature)
+    except (TypeError, ValueError):
+        raise ValueError('invalid number in rule {}'.format(rule))
+    if 'between' in rule:
+        try:
+            start, end = [_minute_of_day(clock) for clock in rule['between']]
+        except (TypeError, ValueError) as e:
+            raise ValueError('invalid between in rule {}: {}'.format(rule, e))
+        if start <= end:
+            predicates.append(lambda window, open_seconds, temperature, minute: start <= minute < end)
+        else:
+            # the period spans midnight
+            predicates.append(lambda window, open_seconds, temperature, minute: minute >= start or minute < end)
+    if 'heating' in rule:
+        heating = bool(rule['heating'])
+        predicates.append(lambda window, open_seconds, temperature, minute: bool(window.get('heating')) == heating)
+
+    return selector, predicates, action
+
+
+class RuleSet:
+    def __init__(self, rules_file, default_rule):
+        """
+        Per room and per device notification rules read from a JSON file, a list of rules or an object with the
+        list in 'rules':
+
+        {"rules": [{"room": "Bedroom", "between": ["22:00", "07:00"], "action": "suppress"},
+                   {"room": ["Kitchen", "Bath"], "min_open_minutes": 5, "max_outside_temperature": 18},
+                   {"device": "0a1b2c", "heating": true, "min_open_minutes": 2}]}
+
+        The first rule whose selectors match a window and whose conditions are all met decides if the window is
+        notified, windows no rule decides on fall back to default_rule. The file is compiled once and compiled
+        again when its modification time changed
+        :param rules_file: path to the rules file
+        :param default_rule: rule applied when no rule of the file matches, see compile_rule
+        :raises ValueError: if the rules file can't be read or contains an invalid rule
+        """
+        self.rules_file = rules_file
+        self.reloads = 0
+        self._default = compile_rule(default_rule)[1:]
+        self._mtime = None
+        self._rules = []
+        self._window_rules = {}
+        self._load()
+
+    def _load(self):
+        try:
+            mtime = os.stat(self.rules_file).st_mtime
+            with open(self.rules_file) as f:
+                rules = json.load(f)
+        except (OSError, IOError, ValueError) as e:
+            raise ValueError('could not read rules file {}: {}'.format(self.rules_file, e))
+        if isinstance(rules, dict):
+            rules = rules.get('rules', [])
+
+        self._rules = [compile_rule(rule) for rule in _as_list(rules)]
+        self._mtime = mtime
+        self._window_rules = {}
+        logging.log(logging.INFO, 'loaded {} rules from {}'.format(len(self._rules), self.rules_file))
+
+    def reload_if_changed(self):
+        """
+        Compiles the rules file again if it was modified since it was loaded. If the new rules are invalid the
+        previous rules are kept
+        :return: True if the rules were reloaded
+        """
+        try:
+            mtime = os.stat(self.rules_file).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+
+        try:
+            self._load()
+        except ValueError as e:
+            # the broken file is not tried again until it is modified
+            self._mtime = mtime
+            logging.log(logging.ERROR, 'keeping the previous rules, could not reload {}: {}'.format(
+                self.rules_file, e))
+            return False
+
+        self.reloads += 1
+        return True
+
+    def allows(self, key, window, open_seconds, outside_temperature, now=None):
+        """
+        Decides if an open window is notified. The rules applying to a window are selected once and cached by its
+        key, so each call only evaluates the conditions of the rules for this window
+        :param key: the key of the window in the window status
+        :param window: the window as returned by window_switch_status
+        :param open_seconds: time in seconds the window is open
+        :param outside_temperature: the outside temperature, None if it is not known
+        :param now: the current time, defaults to now
+        :return: True if the window should be notified
+        """
+        window_rules = self._window_rules.get(key)
+        if window_rules is None or window_rules[0] != (window['name'], window.get('room')):
+            window_rules = self._window_rules[key] = (
+                (window['name'], window.get('room')),
+                [(predicates, action) for selector, predicates, action in self._rules if selector(window)] +
+                [self._default])
+
+        local_time = time.localtime(now)
+        minute = local_time.tm_hour * 60 + local_time.tm_min
+        for predicates, action in window_rules[1]:
+            for predicate in predicates:
+                if not predicate(window, open_seconds, outside_temperature, minute):
+                    break
+            else:
+                return action == 'notify'
+        return False
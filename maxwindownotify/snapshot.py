@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright © 2015 Yves Fauser. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and
+# to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions
+# of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF
+# CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+__author__ = 'yfauser'
+
+import json
+import time
+import hashlib
+import logging
+import urlparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+# longest time in seconds a request waits for a change
+MAX_WAIT = 300
+
+
+class SnapshotStore:
+    def __init__(self):
+        """
+        Latest snapshot of the window and device status, serialized once when it changes so every request is
+        answered from memory. Requests can wait for the next change instead of polling
+        """
+        self.body = None
+        self.etag = None
+        self.changes = 0
+        self._condition = threading.Condition()
+
+    def publish(self, snapshot):
+        """
+        Replaces the snapshot if its content changed, waiting requests are woken up
+        :param snapshot: the JSON serializable snapshot
+        :return: True if the snapshot changed
+        """
+        content = json.dumps(snapshot, sort_keys=True)
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest()[:20])
+        if etag == self.etag:
+            return False
+
+        # the time of the change is not part of the ETag, so an unchanged status keeps its ETag
+        body = json.dumps(dict(snapshot, changed=time.time()), sort_keys=True)
+        with self._condition:
+            self.body, self.etag = body, etag
+            self.changes += 1
+            self._condition.notify_all()
+        return True
+
+    def wait_for_change(self, etag, timeout):
+        """
+        Waits until the snapshot no longer has the given ETag
+        :param etag: the ETag the client already has
+        :param timeout: longest time in seconds to wait
+        :return: tuple of the current body and ETag, the ETag is unchanged if the timeout expired
+        """
+        deadline = time.time() + timeout
+        with self._condition:
+            while self.etag == etag:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return self.body, self.etag
+
+
+class _SnapshotHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    store = None
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path not in ('/', '/snapshot'):
+            self.send_error(404)
+            return
+        try:
+            wait = min(float(urlparse.parse_qs(query).get('wait', ['0'])[0]), MAX_WAIT)
+        except ValueError:
+            self.send_error(400, 'wait has to be a number of seconds')
+            return
+
+        known_etag = self.headers.getheader('If-None-Match')
+        if wait > 0 and (known_etag or self.store.etag is None):
+            body, etag = self.store.wait_for_change(known_etag or None, wait)
+        else:
+            body, etag = self.store.body, self.store.etag
+
+        if body is None:
+            self.send_error(503, 'no data received from MAX Cube yet')
+            return
+        if etag == known_etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.log(logging.DEBUG, 'snapshot request from {}: {}'.format(self.client_address[0], format % args))
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(store, port, address='127.0.0.1'):
+    """
+    Serves the snapshot as JSON on http://address:port/snapshot from a background thread. Clients send the ETag of
+    their copy in If-None-Match to get a 304 if nothing changed, adding '?wait=<seconds>' holds the request until
+    the snapshot changes or the time is up
+    :param store: the SnapshotStore to serve
+    :param port: TCP port to listen on
+    :param address: address to listen on, defaults to the loopback address
+    :return: the HTTP server
+    """
+    class SnapshotHandler(_SnapshotHandler):
+        pass
+    SnapshotHandler.store = store
+
+    server = _ThreadingHTTPServer((address, port), SnapshotHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.log(logging.INFO, 'serving the window and device snapshot on port {}'.format(port))
+    return server